@@ -1,12 +1,25 @@
 #!/usr/bin/python3.8
+import hashlib
+import io
 import json
 import os
+import re
+import selectors
 import sys
+import time
 from datetime import datetime, timedelta
 import math
+import signal
 import subprocess
-from pytz import timezone
 import shutil
+import tempfile
+import threading
+from contextlib import nullcontext, redirect_stdout
+from functools import lru_cache
+from itertools import islice, zip_longest
+
+# Modules only needed by some runs (asyncio, numpy, difflib, concurrent.futures, zoneinfo/pytz) are imported
+# by the functions that use them, so that starting the grader stays fast.
 
 
 """
@@ -28,6 +41,8 @@ To use:
         each compile test. If extra files are required that aren't used for compilation directly (header files,
 		plan.txt, solution.txt, etc.), a separate field in the Question class can be used: Question.extra_files.
 		These files get checked for FilesPresent checks but not used in compiling.
+		Header files are found through the include path (submission/ first, then source/), so they are never
+		copied between directories.
 	4. Points are broken into 3 types: FilesPresent (only gives points if all required files are present),
 		CompileTest for successful compilation, and functionality test defined by output files.
     5. If functionality tests are needed, specify the index which CompileTest in Question.compile_tests
@@ -37,6 +52,8 @@ To use:
 	7. Functionality tests are usually defined using a test driver in ./source/ with the name "test-1-1.cpp"
 		for question 1-1. Cmd line arguments can be put in args-1-1-00 (again, for Q1-1, Test 00), stdin inputs
 		in input-1-1-00, and expected output in output-1-1-00.
+		Drivers for questions with many small tests can instead run every test in one process by supporting
+		the batched driver protocol (see run_batched_driver) and setting Question.batched_driver.
     8. To run, simply call ./run_autograder in this script directory, no input needed as test information
         is either embedded in this script or in ./source/ or ./submission/ directories.
     9. Results are written to results/resuls.json which contains a score and a list of tests performed.
@@ -49,12 +66,20 @@ File Structure:
     - ./source/args-I-J-XY : <optional> contains cmd line arguments for Question I-J, Test XY
     - ./source/input-I-J-XY : <optional> contains input (via stdin redirection) for QI-J-XY as above
     - ./source/output-I-J-XY : <optional> contains expected output that gets diff'd for functionality test
+    - ./source/limits-I-J-XY : <optional> JSON resource limits for QI-J-XY, overriding Question.limits
+    - ./source/compare-I-J-XY : <optional> JSON output comparator for QI-J-XY, overriding Question.comparator
+    - ./source/perf-I-J-NAME-N : <optional> input (via stdin) for size N of Question I-J's performance test NAME
     - ./source/test-I-J.cpp : <optional> contains test driver for Question I-J.
 - ./submission_metadata.json : meta data for current submission,
     contains submitted time/duedate/max grade/previous submissions, etc.
 - ./results/results.json : contains results file that gradescope reads for their output
 - ./setup.sh : contains setup commands. Python module installations need to be done using:
-            "python3.8 -m pip install X", where X is the module/command. This script depends on pytz.
+            "python3.8 -m pip install X", where X is the module/command. This script depends on pytz
+            when run with Python 3.8 (zoneinfo is used from Python 3.9). numpy is optional.
+- ./grading_plan.json : grading plan built from run_autograder's questions and ./source (see build_plan).
+            Build it in setup with "./run_autograder --plan", which also checks the questions for mistakes.
+- ./benchmark.py : <optional> measures grading throughput on a generated assignment, not needed on gradescope.
+            Compare its JSON report before and after changing this script.
 
 Example Use case:
 
@@ -81,9 +106,71 @@ src_prefix = "source/"
 test_program = "program.out"
 program_output = "program.output"
 program_error = "program.err"
-test_timeout = 5                    # Timeout for all program executions (in seconds)
-
-diff_args = ["Z", "B"]              # Ignore trailing whitespace & ignore blank lines
+test_timeout = 5                    # Default CPU time limit for test programs (in seconds)
+test_wall_timeout = test_timeout * 3  # Default wall-clock limit for test programs (in seconds)
+compile_timeout = 30                # Wall-clock limit for each compiler invocation (in seconds)
+output_limit = 1024 * 1024          # Default bytes of stdout a student program may write before it's stopped
+error_limit = 64 * 1024             # Bytes of stderr a student program may write before it's stopped
+batched_driver_flag = "--batched"   # Argument that starts a batched test driver (see run_batched_driver)
+batched_output_limit = 64 * 1024 * 1024  # Bytes of stdout a batched test driver may write for all of its tests
+test_workers = 0                    # Functionality tests run in parallel (0 = one worker per available core, 1 = serial)
+question_workers = 0                # Questions graded concurrently (0 = one worker per available core, 1 = serial)
+compile_workers = 0                 # Translation units compiled concurrently (0 = one worker per available core, 1 = serial)
+include_dirs = [sub_prefix, src_prefix]  # Header search path, submitted headers take priority over provided ones
+compile_flags = ['-std=c++11', '-O2', '-Wall']
+
+# Compile tests whose program is never run (every CompileTest except the tester) only need a pass/fail verdict,
+# so their translation units skip optimisation. They're still compiled and linked to catch missing symbols.
+# Their flags are compile_flags with the optimisation level replaced by -O0.
+check_only_compiles = True
+check_only_flags = ['-O0' if flag.startswith('-O') else flag for flag in compile_flags]
+
+# Compiled objects and linked programs are cached by a hash of their preprocessed source and compiler flags,
+# so unchanged files (e.g. test drivers) are only compiled once. Least recently used entries are evicted
+# once the cache grows past compile_cache_size bytes. Set compile_cache to False to always compile from scratch.
+compile_cache = True
+compile_cache_dir = os.environ.get("GS_AUTOGRADER_CACHE", os.path.expanduser("~/.cache/gs_autograder"))
+compile_cache_size = 512 * 1024 * 1024
+
+# Each question's result is also cached, keyed by its submitted/provided files, fixtures and grading config
+# (including this script), so a resubmission only regrades questions whose inputs changed. Results that depend
+# on the grader's load (wall-clock timeouts, performance tests) aren't cached.
+result_cache = True
+
+# Common standard headers are precompiled once per compiler and flags, and kept in the compile cache.
+# They're built ahead of time by run_autograder --plan (from setup.sh) and once at the start of batch grading,
+# never while grading a single submission, where building them costs more than they save. g++ only uses a
+# precompiled header for the first #include of a file, and falls back to the real header whenever the
+# precompiled one isn't valid, so results are unaffected. Headers provided in source/ aren't precompiled:
+# quoted includes find the real header next to the including file first, so g++ would never use them.
+precompiled_headers = True
+pch_std_headers = ["iostream", "string", "vector"]
+
+# Program output is compared with the expected output in-process, like "diff -ZB":
+# trailing whitespace and blank lines are ignored (see outputs_match for how they differ).
+diff_max_lines = 200                # Maximum lines of diff output given as feedback for a failed test
+diff_max_compare_lines = 5000       # Maximum lines of each output that are aligned to build that feedback
+feedback_limit = 256 * 1024         # Bytes of feedback kept per question, later lines are only counted
+
+# Seconds the whole submission may take to grade (None = no limit). Questions that haven't started their
+# tests when it runs out are skipped, as are the remaining tests and performance trials of questions already
+# running, so there's time to record results before the platform's own timeout.
+time_budget = None
+
+# Wall/CPU time and peak memory of every grading phase and child process are recorded in the hidden
+# "extra_data" section of results.json. If profile_file is set, a summary of each run is also appended to it.
+profile_file = os.environ.get("GS_AUTOGRADER_PROFILE")
+
+# Grade with the asyncio pipeline instead of thread pools: compiles, test runs and output comparisons become
+# stages with their own concurrency limits (compile_workers, test_workers), so one question's tests run while
+# another question is still compiling. Child processes are reaped by asyncio rather than wait4, so profile
+# records only have wall times for them, and a test that ignores SIGXCPU until it's killed at the hard CPU
+# limit gets the generic crash feedback rather than the CPU time limit verdict. Performance tests still
+# run through wait4, so their CPU times are the same with either engine.
+async_engine = False
+
+fixture_kinds = ["args", "input", "output", "limits", "compare"]
+fixture_preload_size = 64 * 1024    # Fixtures up to this many bytes are read into memory when the manifest is loaded
 
 # ========================================================================
 #              Set to true if assignment is a workshop.
@@ -107,6 +194,368 @@ def silent_cleanup():
     silent_remove("program.output")
     silent_remove("testdiff")
 
+# Number of cores this process is allowed to run on
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# Questions and their tests are graded on nested worker pools, so the number of
+# child processes (compilers, student programs, diffs) running at once is bounded here instead.
+_process_slot_count = available_cores()
+_process_slots = threading.BoundedSemaphore(_process_slot_count)
+
+# ===============================
+#           Profiling
+# ===============================
+# Collects timing/resource records for a single run of run_questions
+class Profiler:
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    # phase is the kind of work (e.g. "compile", "test"), name identifies what was done.
+    # max_rss is peak resident memory of a child process in kilobytes.
+    def record(self, phase, name, wall_time, user_time = 0.0, sys_time = 0.0, max_rss = 0):
+        with self.lock:
+            self.records.append({
+                "phase": phase,
+                "name": name,
+                "wall_time": round(wall_time, 6),
+                "user_time": round(user_time, 6),
+                "sys_time": round(sys_time, 6),
+                "max_rss": max_rss
+            })
+
+    def record_run(self, phase, name, run):
+        self.record(phase, name, run.wall_time, run.user_time, run.sys_time, run.max_rss)
+
+    # Totals per phase
+    def summary(self):
+        phases = {}
+        with self.lock:
+            for rec in self.records:
+                total = phases.setdefault(rec["phase"], {"count": 0, "wall_time": 0.0, "user_time": 0.0,
+                                                          "sys_time": 0.0, "max_rss": 0})
+                total["count"] += 1
+                for field in ["wall_time", "user_time", "sys_time"]:
+                    total[field] = round(total[field] + rec[field], 6)
+                total["max_rss"] = max(total["max_rss"], rec["max_rss"])
+        return phases
+
+    def to_json(self):
+        with self.lock:
+            records = list(self.records)
+        return {"summary": self.summary(), "records": records}
+
+# Profiler of the current run, replaced at the start of each run_questions
+profiler = Profiler()
+
+# Records wall time and CPU time of the calling thread for an in-process phase
+class profile_phase:
+    def __init__(self, phase, name):
+        self.phase = phase
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.monotonic()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc):
+        profiler.record(self.phase, self.name, time.monotonic() - self.wall, time.thread_time() - self.cpu)
+        return False
+
+# Appends summary of a run to profile_file, one JSON object per line
+def write_profile(result_json):
+    if not profile_file:
+        return
+    profile = result_json.get("extra_data", {}).get("profile", {})
+    line = {
+        "time": datetime.now().isoformat(),
+        "score": result_json.get("score"),
+        "summary": profile.get("summary", {}),
+        "questions": {rec["name"]: rec["wall_time"] for rec in profile.get("records", []) if rec["phase"] == "question"}
+    }
+    try:
+        with open(profile_file, 'a') as f:
+            f.write(json.dumps(line) + "\n")
+    except OSError as ex:
+        print(f'Unable to write profile to {profile_file} ({ex}).')
+
+# Outcome of a program run through run_captured
+class ProgramRun:
+    def __init__(self):
+        self.returncode = None
+        self.stdout = b""
+        self.stderr = b""
+        self.timed_out = False
+        self.limit_exceeded = None          # "stdout" or "stderr" if that stream went over its byte limit
+        self.resource_limit = None          # "cpu", "memory" or "file_size" if killed for exceeding that rlimit
+        self.wall_time = 0.0
+        self.user_time = 0.0                # CPU time of the process, from wait4
+        self.sys_time = 0.0
+        self.max_rss = 0                    # Peak resident memory in kilobytes
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+# Reaps proc with wait4 so its resource usage can be recorded.
+# Returns (status, rusage), or (None, None) if proc is still running at deadline (None waits forever).
+def wait_process(proc, deadline = None):
+    if deadline is None:
+        _, status, rusage = os.wait4(proc.pid, 0)
+        return status, rusage
+
+    delay = 0.0005
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            return status, rusage
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None, None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.02)
+
+@lru_cache(maxsize=None)
+def find_prlimit():
+    return shutil.which("prlimit")
+
+# Kills every process in the group led by proc, including any children it forked
+def kill_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+# Works out which rlimit (if any) ended the program
+def limit_verdict(result, limits):
+    if limits is None or result.returncode >= 0:
+        return None
+    sig = -result.returncode
+    if limits.cpu_time is not None:
+        if sig == signal.SIGXCPU or (sig == signal.SIGKILL and result.user_time + result.sys_time >= limits.cpu_time):
+            return "cpu"
+    if limits.file_size is not None and sig == signal.SIGXFSZ:
+        return "file_size"
+    if limits.memory is not None:
+        # The memory limit is on address space, which resident memory (max_rss) says nothing about, so only
+        # a reported allocation failure counts: an uncaught std::bad_alloc, or ENOMEM from perror/strerror
+        if b"bad_alloc" in result.stderr or b"Cannot allocate memory" in result.stderr:
+            return "memory"
+    return None
+
+# Returns (cmd, preexec_fn) to start cmd with limits applied
+def limited_command(cmd, limits):
+    if limits is None:
+        return cmd, None
+    if find_prlimit() is not None:
+        # prlimit sets the limits then execs cmd, avoiding preexec_fn which isn't safe with threads
+        return [find_prlimit()] + limits.prlimit_args() + ['--'] + list(cmd), None
+    return cmd, limits.apply
+
+# Runs cmd feeding input_bytes to its stdin, capturing stdout/stderr through pipes.
+# The program is killed if it runs past timeout or writes more than stdout_limit/stderr_limit bytes
+# (None for no limit), so a runaway print loop can't fill the disk or memory.
+# limits sets the program's rlimits. The program runs in its own process group, which is killed once
+# it's done so that forked children can't keep running.
+# hold_slot is False when the caller already holds every process slot (see exclusive_processes).
+def run_captured(cmd, input_bytes = None, timeout = test_timeout, cwd = None,
+                 stdout_limit = output_limit, stderr_limit = error_limit, limits = None, hold_slot = True):
+    result = ProgramRun()
+    cmd, preexec_fn = limited_command(cmd, limits)
+
+    with _process_slots if hold_slot else nullcontext():
+        start = time.monotonic()
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                stdin=subprocess.DEVNULL if input_bytes is None else subprocess.PIPE,
+                                start_new_session=True, preexec_fn=preexec_fn)
+        deadline = time.monotonic() + timeout
+        out_chunks = []
+        err_chunks = []
+        streams = {
+            proc.stdout.fileno(): ["stdout", stdout_limit, out_chunks],
+            proc.stderr.fileno(): ["stderr", stderr_limit, err_chunks],
+        }
+        sizes = {"stdout": 0, "stderr": 0}
+
+        with selectors.DefaultSelector() as selector:
+            for fd in streams:
+                selector.register(fd, selectors.EVENT_READ)
+            if input_bytes is not None:
+                input_view = memoryview(input_bytes)
+                input_offset = 0
+                if len(input_bytes) == 0:
+                    proc.stdin.close()
+                else:
+                    os.set_blocking(proc.stdin.fileno(), False)
+                    selector.register(proc.stdin.fileno(), selectors.EVENT_WRITE)
+
+            while len(selector.get_map()) != 0 and result.limit_exceeded is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    result.timed_out = True
+                    break
+                for key, _ in selector.select(remaining):
+                    fd = key.fd
+                    if fd not in streams:
+                        # Feed the next chunk of input, the program may exit without reading all of it
+                        try:
+                            input_offset += os.write(fd, input_view[input_offset:input_offset + 65536])
+                        except BrokenPipeError:
+                            input_offset = len(input_bytes)
+                        if input_offset >= len(input_bytes):
+                            selector.unregister(fd)
+                            proc.stdin.close()
+                        continue
+
+                    data = os.read(fd, 65536)
+                    if not data:
+                        selector.unregister(fd)
+                        continue
+                    name, limit, chunks = streams[fd]
+                    if limit is None:
+                        chunks.append(data)
+                        continue
+                    chunks.append(data[:max(0, limit - sizes[name])])
+                    sizes[name] += len(data)
+                    if sizes[name] > limit:
+                        result.limit_exceeded = name
+                        break
+
+        if result.timed_out or result.limit_exceeded is not None:
+            kill_group(proc)
+        status, rusage = wait_process(proc, deadline)
+        if status is None:
+            # Program closed its output but kept running
+            result.timed_out = True
+            kill_group(proc)
+            status, rusage = wait_process(proc)
+        result.wall_time = time.monotonic() - start
+        kill_group(proc)
+        for f in [proc.stdin, proc.stdout, proc.stderr]:
+            if f is not None and not f.closed:
+                f.close()
+
+    proc.returncode = exit_code(status)
+    result.returncode = proc.returncode
+    result.user_time = rusage.ru_utime
+    result.sys_time = rusage.ru_stime
+    result.max_rss = rusage.ru_maxrss
+    result.stdout = b"".join(out_chunks)
+    result.stderr = b"".join(err_chunks)
+    if not result.timed_out and result.limit_exceeded is None:
+        result.resource_limit = limit_verdict(result, limits)
+    return result
+
+# Number of workers to use for a workers setting (0 = one per available core)
+def pool_size(workers):
+    if workers <= 0:
+        return available_cores()
+    return workers
+
+# Maps func over items on a pool of up to workers threads (0 = one per available core).
+# Results are returned in the same order as items.
+def run_pool(func, items, workers):
+    items = list(items)
+    workers = max(1, min(pool_size(workers), len(items)))
+
+    if workers == 1:
+        return [func(item) for item in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+# Resource limits for a test program. None means unlimited.
+# Enforced with rlimits, except wall_time which the grader enforces by killing the program's process group.
+class Limits:
+    def __init__(self, cpu_time = None, wall_time = None, memory = None, open_files = None, file_size = None,
+                 output_size = None):
+        self.cpu_time = cpu_time                    # CPU seconds (user + sys)
+        self.wall_time = wall_time                  # Real seconds, should allow for a busy grading machine
+        self.memory = memory                        # Address space in bytes
+        self.open_files = open_files                # Maximum number of open file descriptors
+        self.file_size = file_size                  # Largest file the program may write, in bytes
+        self.output_size = output_size              # Bytes of stdout captured before the program is stopped
+
+    # Returns new Limits where any limits set in other replace those in self
+    def merge(self, other):
+        merged = Limits(**vars(self))
+        if other is not None:
+            for name, value in vars(other).items():
+                if value is not None:
+                    setattr(merged, name, value)
+        return merged
+
+    # prlimit(1) arguments that apply the rlimits
+    def prlimit_args(self):
+        args = []
+        if self.cpu_time is not None:
+            # SIGXCPU at the soft limit, SIGKILL a second later if that's ignored
+            cpu = math.ceil(self.cpu_time)
+            args.append(f'--cpu={cpu}:{cpu + 1}')
+        if self.memory is not None:
+            args.append(f'--as={self.memory}')
+        if self.open_files is not None:
+            args.append(f'--nofile={self.open_files}')
+        if self.file_size is not None:
+            args.append(f'--fsize={self.file_size}')
+        return args
+
+    # Sets the rlimits on the current process, used in the child if prlimit isn't installed
+    def apply(self):
+        import resource
+        if self.cpu_time is not None:
+            cpu = math.ceil(self.cpu_time)
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+        if self.memory is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory, self.memory))
+        if self.open_files is not None:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (self.open_files, self.open_files))
+        if self.file_size is not None:
+            resource.setrlimit(resource.RLIMIT_FSIZE, (self.file_size, self.file_size))
+
+# Limits for every test program unless overridden by Question.limits or a limits-I-J-XY file.
+# CPU time rather than wall time decides whether a program is too slow, so a correct solution doesn't
+# fail just because the grader is busy. The wall limit only catches programs that sleep or block.
+# Tests with large outputs can raise output_size, e.g. a limits file holding {"output_size": 67108864}.
+default_limits = Limits(cpu_time=test_timeout, wall_time=test_wall_timeout, open_files=256,
+                        file_size=16 * 1024 * 1024, output_size=output_limit)
+
+# How a test's output is compared with its expected output. mode is one of:
+#   "diff"              line by line, ignoring trailing whitespace and blank lines (like diff -ZB)
+#   "case-insensitive"  as "diff", ignoring letter case
+#   "token"             whitespace separated tokens must match, however they're split over lines
+#   "regex-line"        each non-blank expected line is a regular expression the output line must fully match
+#   "numeric"           as "token", but numbers only need to be within abs_tol + rel_tol * |expected|
+comparator_modes = ["diff", "case-insensitive", "token", "regex-line", "numeric"]
+
+class Comparator:
+    def __init__(self, mode = None, abs_tol = None, rel_tol = None):
+        if mode is not None and mode not in comparator_modes:
+            raise ValueError(f'unknown comparator mode "{mode}"')
+        self.mode = mode
+        self.abs_tol = abs_tol                      # Absolute tolerance of "numeric" comparisons
+        self.rel_tol = rel_tol                      # Tolerance relative to the expected value
+
+    # Returns new Comparator where any settings in other replace those in self
+    def merge(self, other):
+        merged = Comparator(**vars(self))
+        if other is not None:
+            for name, value in vars(other).items():
+                if value is not None:
+                    setattr(merged, name, value)
+        return merged
+
+# Comparator for every test unless overridden by Question.comparator or a compare-I-J-XY file.
+# The tolerances are numpy.isclose's defaults.
+default_comparator = Comparator(mode="diff", abs_tol=1e-8, rel_tol=1e-5)
+
 # Collection of data for each compiling test
 class CompileTest:
     def __init__(self, submitted_files = [], provided_files = [], points = 0):
@@ -128,7 +577,8 @@ class CompileTest:
 # If tester_idx is left as -1, then compiling won't be forced
 class Question:
     def __init__(self, question_id, max_points = 0, compile_tests = [], tester_idx = -1,
-                 file_points = 0, test_points = 0, extra_files = []):
+                 file_points = 0, test_points = 0, extra_files = [], limits = None, batched_driver = False,
+                 comparator = None, perf_tests = []):
         self.qid = question_id
         self.max = max_points
         self.f_points = file_points                 # Points given if all req files are present
@@ -144,6 +594,65 @@ class Question:
         # List of extra files to check for that aren't related to compiling (plan.txt, solution.txt, etc.)
         self.extra_files = extra_files
 
+        # Limits object overriding default_limits for this question's tests
+        self.limits = limits
+
+        # True if the test driver supports running many tests in one process (see run_batched_driver)
+        self.batched_driver = batched_driver
+
+        # Comparator object overriding default_comparator for this question's tests
+        self.comparator = comparator
+
+        # List of PerformanceTest objects, run with the test driver after the functionality tests
+        self.perf_tests = perf_tests
+
+        # Resolved from the grading plan by apply_plan, otherwise worked out when needed
+        self.required_files = None
+        self.provided_hash = None
+
+    # Required files in the order they're listed, so feedback is identical between runs
+    def get_required_files(self):
+        if self.required_files is not None:
+            return self.required_files
+        req_file_names = {}
+        for test in self.compile_tests:
+            for cur_file in test.submitted_files:
+                req_file_names[cur_file] = True
+        for cur_file in self.extra_files:
+            req_file_names[cur_file] = True
+        return list(req_file_names)
+
+    # Returns index into compile_tests of the test driver's CompileTest, or -1 if there are no compile tests
+    def get_tester_idx(self):
+        if len(self.compile_tests) == 0:
+            return -1
+        return self.tester_idx % len(self.compile_tests)
+
+
+# Grades the efficiency of a question's test driver by running it over a series of input sizes (see
+# run_performance_test). name identifies the test in feedback and in its input files.
+# Points are awarded separately for the largest size running within max_cpu_time seconds (time_points)
+# and for the running time growing no faster than complexity (complexity_points), either can be None.
+class PerformanceTest:
+    def __init__(self, name, sizes, time_points = 0, max_cpu_time = None, complexity_points = 0, complexity = None,
+                 args = "{size}", trials = 5, warmup = 1, tolerance = 0.3):
+        if complexity is not None and complexity not in complexity_classes:
+            raise ValueError(f'unknown complexity class "{complexity}"')
+        if len(sizes) == 0 or min(sizes) < 2:
+            raise ValueError("performance test sizes must be at least 2")
+        self.name = name
+        self.sizes = sorted(sizes)
+        self.time_points = time_points
+        self.max_cpu_time = max_cpu_time
+        self.complexity_points = complexity_points
+        self.complexity = complexity                # Key of complexity_classes, e.g. "n log n"
+        self.args = args                            # Program argument, {size} is replaced with the input size
+        self.trials = trials                        # Measured runs per size, the fastest is used
+        self.warmup = warmup                        # Unmeasured runs per size before the trials
+        self.tolerance = tolerance                  # How much larger than expected the fitted exponent may be
+
+    def input_name(self, qid, size):
+        return f'perf-{qid}-{self.name}-{size}'
 
 # Checks if passed file names are present in sub_prefix directory
 # Adds score and feedback to current_test
@@ -182,27 +691,396 @@ def check_present(current_test, file_names = [], max_score = 0):
 
     return missing_files
 
+# Returns g++ command using the given flags (compile_flags by default) and include path, followed by extra arguments
+def compiler_cmd(*args, flags = None):
+    if flags is None:
+        flags = compile_flags
+    cmd = ['g++'] + flags
+    # Precompiled headers are searched before the real headers, g++ skips any that don't match
+    pch_dir = get_pch_dir(flags)
+    if pch_dir is not None:
+        cmd += ['-I', pch_dir]
+    for include_dir in include_dirs:
+        cmd += ['-I', include_dir]
+    return cmd + list(args)
+
+# Runs a compiler command, treating a compiler that runs past test_timeout as a failed compile
+def run_compiler(cmd):
+    print(" ".join(cmd))
+    run = run_captured(cmd, timeout=compile_timeout, stdout_limit=None, stderr_limit=None)
+    return compiler_result(cmd, run)
+
+# Records the profile of a compiler run and converts it to a CompletedProcess with text output
+def compiler_result(cmd, run):
+    # Profile records are named by the compiler arguments, without the common flags and include path
+    name = []
+    args = iter(cmd[1:])
+    for arg in args:
+        if arg == '-I':
+            next(args, None)
+        elif arg not in compile_flags and arg not in check_only_flags:
+            name.append(arg)
+    profiler.record_run("compiler", " ".join(name), run)
+    if run.timed_out:
+        return subprocess.CompletedProcess(cmd, -1, "", f"Compilation timed out after {compile_timeout} seconds.\n")
+    return subprocess.CompletedProcess(cmd, run.returncode, run.stdout.decode(errors='replace'),
+                                       run.stderr.decode(errors='replace'))
+
+# ===============================
+#         Compile cache
+# ===============================
+def cache_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        h.update(part)
+        h.update(b"\0")
+    return h.hexdigest()
+
+# Identifies the compiler, so upgrading g++ doesn't reuse objects it didn't build
+@lru_cache(maxsize=None)
+def compiler_version():
+    try:
+        return subprocess.run(['g++', '--version'], capture_output=True, text=True).stdout
+    except OSError:
+        return ""
+
+# Returns True if the compile cache is enabled and its directory is writable
+@lru_cache(maxsize=None)
+def compile_cache_enabled():
+    if not compile_cache:
+        return False
+    try:
+        for kind in ["objects", "programs"]:
+            os.makedirs(os.path.join(compile_cache_dir, kind), exist_ok=True)
+    except OSError as ex:
+        print(f'Compile cache unavailable ({ex}), compiling without cache.')
+        return False
+    if not os.access(compile_cache_dir, os.W_OK):
+        print(f'Compile cache {compile_cache_dir} is not writable, compiling without cache.')
+        return False
+    return True
+
+def cache_entry(kind, key):
+    return os.path.join(compile_cache_dir, kind, key)
+
+# Returns True if entry is cached, marking it as recently used
+def cache_lookup(path):
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+# Atomically moves a freshly built file into the cache then evicts old entries
+def cache_store(tmp_path, path):
+    os.replace(tmp_path, path)
+    evict_compile_cache()
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+# Removes least recently used objects/programs/precompiled headers until the cache fits in compile_cache_size
+def evict_compile_cache():
+    entries = []
+    total = 0
+    for kind in ["objects", "programs", "pch", "results"]:
+        kind_dir = os.path.join(compile_cache_dir, kind)
+        try:
+            scan = list(os.scandir(kind_dir))
+        except OSError:
+            continue
+        for entry in scan:
+            # Skip files that are still being written
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                st = entry.stat()
+                size = dir_size(entry.path) if entry.is_dir() else st.st_size
+            except OSError:
+                continue
+            entries.append((st.st_mtime, size, entry.path))
+            total += size
+
+    entries.sort()
+    for _, size, path in entries:
+        if total <= compile_cache_size:
+            break
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            silent_remove(path)
+        total -= size
+
+def cache_tmp_path(kind):
+    kind_dir = os.path.join(compile_cache_dir, kind)
+    os.makedirs(kind_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=kind_dir, suffix=".tmp")
+    os.close(fd)
+    return tmp_path
+
+# ===============================
+#      Precompiled headers
+# ===============================
+_pch_lock = threading.Lock()
+_pch_dirs = {}
+
+# Returns directory of precompiled headers built with flags, or None if unavailable. They're only built
+# if build is True, otherwise None is returned until they've been built (see build_precompiled_headers).
+# The directory is keyed by the compiler and flags.
+def get_pch_dir(flags, build = False):
+    if not precompiled_headers or not compile_cache_enabled():
+        return None
+
+    key = " ".join(flags)
+    with _pch_lock:
+        if _pch_dirs.get(key) is None and (build or key not in _pch_dirs):
+            try:
+                _pch_dirs[key] = find_pch_dir(flags, build)
+            except OSError as ex:
+                print(f'Unable to create precompiled headers ({ex}), compiling without them.')
+                _pch_dirs[key] = None
+        return _pch_dirs[key]
+
+# Builds the precompiled headers for every set of compile flags, so compiles can use them from then on
+def build_precompiled_headers():
+    for flags in [compile_flags] + ([check_only_flags] if check_only_compiles else []):
+        get_pch_dir(flags, build=True)
+
+def find_pch_dir(flags, build):
+    pch_root = os.path.join(compile_cache_dir, "pch")
+    pch_dir = os.path.join(pch_root, cache_key(compiler_version(), " ".join(flags), *pch_std_headers))
+    if cache_lookup(pch_dir):
+        return pch_dir
+    if not build:
+        return None
+
+    print(f'Building precompiled headers for flags {" ".join(flags)}...')
+    try:
+        os.makedirs(pch_root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=pch_root, suffix=".tmp")
+    except OSError as ex:
+        print(f'Unable to create precompiled headers ({ex}).')
+        return None
+
+    # Each header is precompiled from a stub that includes it
+    for header in pch_std_headers:
+        stub = os.path.join(tmp_dir, header + ".stub")
+        with open(stub, 'w') as f:
+            f.write(f'#include <{header}>\n')
+        cmd = ['g++'] + flags + ['-x', 'c++-header', stub, '-o', os.path.join(tmp_dir, header + ".gch")]
+        if run_compiler(cmd).returncode != 0:
+            # Compiles fall back to the real header when the precompiled one is missing
+            print(f'Failed to precompile {header}, it will be compiled normally.')
+            silent_remove(os.path.join(tmp_dir, header + ".gch"))
+        silent_remove(stub)
+
+    try:
+        os.rename(tmp_dir, pch_dir)
+    except OSError:
+        # Another grader built the same headers first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict_compile_cache()
+    return pch_dir
+
+def is_header(path):
+    return path.endswith(".h") or path.endswith(".hpp")
+
+# Object file for path when the compile cache is disabled
+def build_object_path(path, build_dir, flags):
+    return os.path.join(build_dir, cache_key(path, " ".join(flags)) + ".o")
+
+# Compile cache entries of an object (keyed by its preprocessed source) and a program (keyed by its objects)
+def object_cache_entry(flags, preprocessed):
+    return cache_entry("objects", cache_key(compiler_version(), " ".join(flags), preprocessed) + ".o")
+
+def program_cache_entry(obj_paths):
+    obj_keys = [os.path.basename(obj_path) for obj_path in obj_paths]
+    return cache_entry("programs", cache_key(compiler_version(), " ".join(compile_flags), *obj_keys))
+
+# Compiles a single translation unit to an object file. With the compile cache enabled, objects are
+# cached by their preprocessed contents, otherwise they're written to build_dir. If the cache fails part
+# way (e.g. the disk is full), the file is compiled again without it.
+# check_only compiles without optimisation for programs that are never run.
+# Returns (object path or None on failure, CompletedProcess of the failing step or None)
+def compile_object(path, build_dir, check_only = False):
+    flags = check_only_flags if check_only else compile_flags
+    if compile_cache_enabled():
+        try:
+            return compile_cached_object(path, flags)
+        except OSError as ex:
+            print(f'Compile cache unavailable ({ex}), compiling {path} without cache.')
+    return compile_uncached_object(path, build_dir, flags)
+
+def compile_uncached_object(path, build_dir, flags):
+    obj_path = build_object_path(path, build_dir, flags)
+    compiler_process = run_compiler(compiler_cmd('-c', path, '-o', obj_path, flags=flags))
+    if compiler_process.returncode != 0:
+        return None, compiler_process
+    return obj_path, None
+
+def compile_cached_object(path, flags):
+    preprocess = run_compiler(compiler_cmd('-E', '-P', path, flags=flags))
+    if preprocess.returncode != 0:
+        return None, preprocess
+
+    obj_path = object_cache_entry(flags, preprocess.stdout)
+    if cache_lookup(obj_path):
+        print(f'Using cached object for {path}')
+        return obj_path, None
+
+    tmp_path = cache_tmp_path("objects")
+    try:
+        compiler_process = run_compiler(compiler_cmd('-c', path, '-o', tmp_path, flags=flags))
+        if compiler_process.returncode != 0:
+            return None, compiler_process
+        cache_store(tmp_path, obj_path)
+    finally:
+        # Already moved into the cache unless the compile or the move failed
+        silent_remove(tmp_path)
+    return obj_path, None
+
+# Links objects into program, reusing a cached program if these objects have been linked before.
+# If the cache fails part way, the program is linked again without it.
+# Returns CompletedProcess of the linker if linking failed, otherwise None
+def link_objects(obj_paths, program):
+    if compile_cache_enabled():
+        try:
+            return link_cached_program(obj_paths, program)
+        except OSError as ex:
+            print(f'Compile cache unavailable ({ex}), linking {program} without cache.')
+            silent_remove(program)
+    linker_process = run_compiler(compiler_cmd('-o', program, *obj_paths))
+    if linker_process.returncode != 0:
+        return linker_process
+    return None
+
+def link_cached_program(obj_paths, program):
+    program_path = program_cache_entry(obj_paths)
+    if cache_lookup(program_path):
+        print(f'Using cached program for objects {" ".join(os.path.basename(p) for p in obj_paths)}')
+    else:
+        tmp_path = cache_tmp_path("programs")
+        try:
+            linker_process = run_compiler(compiler_cmd('-o', tmp_path, *obj_paths))
+            if linker_process.returncode != 0:
+                return linker_process
+            cache_store(tmp_path, program_path)
+        finally:
+            silent_remove(tmp_path)
+    shutil.copy2(program_path, program)
+    return None
+
+# Compiles every unique translation unit used by any CompileTest in questions exactly once.
+# Files only used by programs that are never run are compiled check-only (see check_only_compiles).
+# Returns dictionary of source path -> (object path or None, CompletedProcess of failing step or None),
+# which check_compile_target uses to link each target without recompiling shared files.
+# Files that hadn't started compiling when the time budget ran out are left out.
+def build_objects(questions, build_dir):
+    paths = translation_units(questions)
+    print(f'Compiling {len(paths)} translation units: {" ".join(paths)}')
+    built = run_pool(lambda path: None if budget_exhausted() else compile_object(path, build_dir, not paths[path]),
+                     paths, compile_workers)
+    return {path: result for path, result in zip(paths, built) if result is not None}
+
+# True if build_objects compiled any translation unit used by q
+def question_compiled(q, objects):
+    return any(path in objects for path in translation_units([q]))
+
+# Returns {source path: True if the file is part of a test driver and must be fully optimised}
+# for every translation unit used by questions
+def translation_units(questions):
+    paths = {}
+    for q in questions:
+        tester_idx = q.get_tester_idx()
+        for idx, compile_test in enumerate(q.compile_tests):
+            optimised = idx == tester_idx or not check_only_compiles
+            for path in compile_test.get_file_paths():
+                if not is_header(path):
+                    paths[path] = paths.get(path, False) or optimised
+    return paths
+
+# Builds program from file_paths, taking objects from the already built objects where possible.
+# Returns CompletedProcess-like object with the compiler output of any failing steps,
+# or None if the time budget ran out before every file it needs was compiled.
+def build_program(file_paths, program, objects = None, check_only = False):
+    build_dir = os.path.dirname(os.path.abspath(program))
+    obj_paths = []
+    failures = []
+    for path in file_paths:
+        # Headers listed alongside sources aren't translation units of their own
+        if is_header(path):
+            continue
+        if objects is not None and path in objects:
+            obj_path, failure = objects[path]
+        elif budget_exhausted():
+            return None
+        else:
+            obj_path, failure = compile_object(path, build_dir, check_only)
+        if obj_path is not None and not os.path.exists(obj_path):
+            # Evicted from the compile cache by another grader since it was compiled
+            flags = check_only_flags if check_only else compile_flags
+            obj_path, failure = compile_uncached_object(path, build_dir, flags)
+        if failure is not None:
+            failures.append(failure)
+        obj_paths.append(obj_path)
+
+    if len(failures) == 0:
+        failure = link_objects(obj_paths, program)
+        if failure is not None:
+            failures.append(failure)
+    return build_result(file_paths, failures)
+
+# Combines the compiler output of failed build steps into a single CompletedProcess-like object
+def build_result(file_paths, failures):
+    stdout = "".join(failure.stdout for failure in failures)
+    stderr = "".join(failure.stderr for failure in failures)
+    return subprocess.CompletedProcess(file_paths, 1 if failures else 0, stdout, stderr)
+
 # Set current_test to None to not record outcome of compile (used for creating test driver)
-def check_compile_target(current_test, points, compile_test):
+# program is the path of the binary to create, usually inside the question's workspace
+# objects optionally contains translation units already compiled by build_objects
+# check_only builds without optimisation, for programs that only need to compile and are never run
+def check_compile_target(current_test, points, compile_test, program = test_program, objects = None,
+                         check_only = False):
 
     file_paths = compile_test.get_file_paths()
     file_names = compile_test.get_file_names()
 
-    out_str = ""
-
     if current_test == None:
         print("Compiling without recording (for test driver).")
 
-    cmd = ['g++', '-std=c++11', '-o', f'{test_program}', '-O2', '-Wall']
-    for path in file_paths:
-        cmd.append(path)
-
     print(f'Compiling {test_program} using files: {" ".join(file_names)}...')
-    print(" ".join(cmd))
-    compiler_process = subprocess.run(cmd, capture_output=True, text=True, timeout=test_timeout)
+    with profile_phase("check_compile_target", " ".join(file_names)):
+        compiler_process = build_program(file_paths, program, objects, check_only)
+    return record_compile(current_test, points, compile_test, program, compiler_process)
+
+# Awards points for compile_test if program was built, otherwise gives the compiler output as feedback.
+# compiler_process is None if the build was skipped because the time budget ran out.
+# Returns True if program was built.
+def record_compile(current_test, points, compile_test, program, compiler_process):
+    file_paths = compile_test.get_file_paths()
+    file_names = compile_test.get_file_names()
 
+    out_str = ""
     success = False
-    if os.path.isfile(f'{test_program}'):
+    if compiler_process is None:
+        score = 0
+        out_str = (f'Compiling {test_program} with files {" ".join(file_names)} skipped: '
+                   f'the grading time limit of {time_budget} seconds ran out.\n')
+        print(out_str, end='')
+        # Like a skipped test, this depends on how busy the grader was
+        if current_test != None:
+            current_test["cacheable"] = False
+    elif os.path.isfile(f'{program}'):
         score = points
         print(f'{test_program} compiled successfully.')
         out_str = f'Successfully compiled {test_program} with files {" ".join(file_names)}. +{points} marks\n'
@@ -225,137 +1103,840 @@ def check_compile_target(current_test, points, compile_test):
         current_test["output"] += out_str
     return success
 
+# ===============================
+#         Test manifest
+# ===============================
 # Assumes I/O is done via files using following format:
 #   - Program Args:     args-I-J-XY     [optional]
 #   - Input:            input-I-J-XY    [optional]
 #   - Expected output:  output-I-J-XY
 #   - Test driver:      test-I-J.cpp	[optional]
-# Where I-J is question I, subquestion J, XY is two digit test id (e.g. 01)
+# Where I-J is question I, subquestion J, XY is the test id (e.g. 01)
 # Example filenames for questions 3-1 with 2 test cases:
 # args-3-1-00, args-3-1-01, input-3-1-00, input-3-1-01, output-3-1-00, output-3-1-01, test-3-1.cpp
-# Assumes test ids (XY) is sequential from 00 -> 99. If XY is not found, then test ids > XY are ignored.
+# Test ids can be any width and don't need to be sequential: every output file found defines a test.
+# source/ is scanned once and the resulting manifest is cached on disk until source/ changes.
+
+# Fixture files of a single functionality test
+class TestCase:
+    def __init__(self, qid, tid):
+        self.qid = qid
+        self.tid = tid
+        self.files = {}                 # Fixture kind ("args", "input", "output") -> path
+        self.data = {}                  # Fixture kind -> contents, for fixtures small enough to preload
+
+    # Returns contents of fixture kind as bytes, or None if the test doesn't have one
+    def read(self, kind):
+        if kind in self.data:
+            return self.data[kind]
+        path = self.files.get(kind)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def preload(self):
+        for kind, path in self.files.items():
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read(fixture_preload_size + 1)
+            except OSError:
+                continue
+            if len(data) <= fixture_preload_size:
+                self.data[kind] = data
+
+# Numeric test ids are ordered by value (so 9 < 10 < 100), any others after them alphabetically
+def test_id_order(tid):
+    if tid.isdigit():
+        return (0, int(tid), tid)
+    return (1, 0, tid)
+
+# Scans src_dir once, returning {qid: {tid: {kind: file name}}} for every fixture file
+def scan_fixtures(src_dir):
+    index = {}
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            kind, _, rest = entry.name.partition('-')
+            if kind not in fixture_kinds:
+                continue
+            qid, _, tid = rest.rpartition('-')
+            if qid == "" or tid == "" or not entry.is_file():
+                continue
+            index.setdefault(qid, {}).setdefault(tid, {})[kind] = entry.name
+    return index
+
+def manifest_cache_path(src_dir):
+    return os.path.join(compile_cache_dir, "manifests", cache_key(os.path.abspath(src_dir)) + ".json")
+
+# Returns fixture index for src_dir, from the on-disk cache if src_dir hasn't changed since it was scanned.
+# Adding, removing or renaming a fixture updates the directory's mtime and so invalidates the cache.
+def load_fixture_index(src_dir):
+    mtime = os.stat(src_dir).st_mtime_ns
+    cache_path = manifest_cache_path(src_dir)
+    if compile_cache_enabled():
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached["mtime"] == mtime and cached["kinds"] == fixture_kinds:
+                return cached["index"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    index = scan_fixtures(src_dir)
+    if compile_cache_enabled():
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+            with os.fdopen(fd, 'w') as f:
+                json.dump({"mtime": mtime, "kinds": fixture_kinds, "index": index}, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as ex:
+            print(f'Unable to cache test manifest ({ex}).')
+    return index
+
+_manifest_lock = threading.Lock()
+_manifests = {}
+
+# Returns {qid: [TestCase, ...]} for every question with tests in src_dir, tests in id order.
+# Only tests with an expected output file are included.
+def get_manifest(src_dir = src_prefix):
+    key = (os.path.abspath(src_dir), os.stat(src_dir).st_mtime_ns)
+    with _manifest_lock:
+        if key not in _manifests:
+            manifest = {}
+            for qid, tests in load_fixture_index(src_dir).items():
+                cases = []
+                for tid in sorted(tests, key=test_id_order):
+                    if "output" not in tests[tid]:
+                        continue
+                    case = TestCase(qid, tid)
+                    for kind, name in tests[tid].items():
+                        case.files[kind] = os.path.join(src_dir, name)
+                    case.preload()
+                    cases.append(case)
+                manifest[qid] = cases
+            _manifests[key] = manifest
+        return _manifests[key]
+
+def get_test_cases(qid):
+    return get_manifest().get(qid, [])
+
 def get_test_ids(qid):
-    out_name = f'{src_prefix}output-{qid}-'
-    test_ids = []
-    for X in range(10):
-        for Y in range(10):
-            cur_id = str(X) + str(Y)
-            cur_name = out_name + cur_id
-            if os.path.isfile(cur_name):
-                test_ids.append(cur_id)
+    return [case.tid for case in get_test_cases(qid)]
+
+# ===============================
+#       Output comparison
+# ===============================
+# Removes trailing whitespace (diff -Z)
+def normalise_line(line):
+    return line.rstrip(' \t\r\n\f\v')
+
+# Yields (line number, line) for every line of f that isn't blank (diff -B)
+def content_lines(f):
+    for num, line in enumerate(f, 1):
+        line = normalise_line(line)
+        if line:
+            yield num, line
+
+# Lines are only split on "\n" so that a stray "\r" counts as trailing whitespace, as it does for diff
+def open_output(path):
+    return open(path, 'r', newline='\n', errors='replace')
+
+def output_stream(data):
+    return io.StringIO(data.decode(errors='replace'), newline='\n')
+
+# Streams both outputs line by line, stopping at the first difference. fold ignores letter case.
+# Blank lines are dropped before comparing, so outputs match whenever their other lines do. diff -B instead
+# ignores a change only if every line in it is blank, which depends on how diff aligned the files: for
+# "b\n\n" and " \n\f\v\n\f\nb\t" it pairs the blank lines up and reports b as a change. Outputs that
+# diff -ZB accepts are always accepted here, but a few it rejects are accepted too.
+def outputs_match(exp_f, act_f, fold = False):
+    for exp, act in zip_longest(content_lines(exp_f), content_lines(act_f)):
+        if exp is None or act is None:
+            return False
+        if exp[1] != act[1] and (not fold or exp[1].casefold() != act[1].casefold()):
+            return False
+    return True
+
+# Keeps at most diff_max_lines lines of feedback
+def limit_lines(out_lines):
+    omitted = len(out_lines) - diff_max_lines
+    if omitted > 0:
+        out_lines = out_lines[:diff_max_lines]
+        out_lines.append(f'... {omitted} more lines of differences not shown')
+    return out_lines
+
+def diff_range(lines, start, end):
+    first = lines[start][0]
+    last = lines[end - 1][0]
+    if first == last:
+        return f'{first}'
+    return f'{first},{last}'
+
+# Line number of the content line before index, used for the position of added/deleted lines
+def diff_position(lines, index):
+    if index == 0:
+        return 0
+    return lines[index - 1][0]
+
+# Builds feedback in the same format as diff's normal output ("2c2", "< expected", "---", "> actual"),
+# using the original line numbers of each output. At most diff_max_lines lines are returned.
+def diff_excerpt(exp_f, act_f, fold = False):
+    exp = list(islice(content_lines(exp_f), diff_max_compare_lines))
+    act = list(islice(content_lines(act_f), diff_max_compare_lines))
+    truncated = next(exp_f, None) is not None or next(act_f, None) is not None
+
+    from difflib import SequenceMatcher
+    key = str.casefold if fold else str
+    matcher = SequenceMatcher(None, [key(line) for _, line in exp], [key(line) for _, line in act], autojunk=False)
+    out_lines = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        if tag == 'delete':
+            out_lines.append(f'{diff_range(exp, i1, i2)}d{diff_position(act, j1)}')
+        elif tag == 'insert':
+            out_lines.append(f'{diff_position(exp, i1)}a{diff_range(act, j1, j2)}')
+        else:
+            out_lines.append(f'{diff_range(exp, i1, i2)}c{diff_range(act, j1, j2)}')
+        out_lines += ['< ' + line for _, line in exp[i1:i2]]
+        if tag == 'replace':
+            out_lines.append('---')
+        out_lines += ['> ' + line for _, line in act[j1:j2]]
+
+    out_lines = limit_lines(out_lines)
+    if truncated:
+        out_lines.append(f'... only the first {diff_max_compare_lines} lines of output were compared in detail')
+    return "\n".join(out_lines) + "\n"
+
+# Parses each token as a number, falling back to exact comparison for tokens that aren't numbers
+def values_close(exp, act, comparator):
+    try:
+        exp_value = float(exp)
+        act_value = float(act)
+    except ValueError:
+        return exp == act
+    if math.isnan(exp_value) or math.isnan(act_value):
+        return math.isnan(exp_value) and math.isnan(act_value)
+    if math.isinf(exp_value) or math.isinf(act_value):
+        return exp_value == act_value
+    return abs(act_value - exp_value) <= comparator.abs_tol + comparator.rel_tol * abs(exp_value)
+
+# numpy is optional, it makes the "numeric" comparator vectorised
+@lru_cache(maxsize=None)
+def optional_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+# Whitespace to the separator given to numpy.fromstring. With a space as the separator fromstring would
+# also split tokens such as "1-2", so the output's whitespace is turned into commas.
+whitespace_commas = bytes.maketrans(b" \t\n\r\x0b\x0c", b",,,,,,")
+
+# Parses output (bytes) into a numpy array with a single fromstring call over the whole buffer, rather than
+# converting each token. Returns None if numpy isn't installed or any token isn't a number.
+def parse_numbers(output):
+    numpy = optional_numpy()
+    if numpy is None or b"," in output:
+        return None
+    text = output.strip()
+    if len(text) == 0:
+        return numpy.empty(0)
+    joined = text.translate(whitespace_commas)
+    # Runs of whitespace are joined into a single separator, only needed if the output isn't evenly spaced
+    if b",," in joined:
+        joined = b",".join(text.split())
+    try:
+        values = numpy.fromstring(joined, dtype=numpy.float64, sep=",")
+    except ValueError:
+        return None
+    # Older numpy versions stop at the first token that isn't a number instead of raising
+    if len(values) != joined.count(b",") + 1:
+        return None
+    return values
+
+# Returns (indices of the numbers of output that don't match expected, expected count, output count) for
+# outputs that are entirely numbers, otherwise None. The tolerances are those of values_close.
+def number_mismatches(expected, output, comparator):
+    exp_values = parse_numbers(expected)
+    act_values = parse_numbers(output) if exp_values is not None else None
+    if act_values is None:
+        return None
+    numpy = optional_numpy()
+    count = min(len(exp_values), len(act_values))
+    close = numpy.isclose(act_values[:count], exp_values[:count], rtol=comparator.rel_tol, atol=comparator.abs_tol,
+                          equal_nan=True)
+    return numpy.flatnonzero(~close).tolist(), len(exp_values), len(act_values)
+
+# Returns indices of the tokens of act that don't match exp (up to the length of the shorter one)
+def token_mismatches(exp, act, comparator):
+    count = min(len(exp), len(act))
+    if comparator.mode != "numeric":
+        return [idx for idx in range(count) if exp[idx] != act[idx]]
+    return [idx for idx in range(count) if not values_close(exp[idx], act[idx], comparator)]
+
+# Compares the whitespace separated tokens of both outputs ("token" and "numeric" comparators).
+# Outputs that are only numbers are compared as arrays when numpy is installed, and only split into
+# tokens to give feedback if they don't match.
+def compare_tokens(expected, output, comparator):
+    numbers = number_mismatches(expected, output, comparator) if comparator.mode == "numeric" else None
+    if numbers is not None and len(numbers[0]) == 0 and numbers[1] == numbers[2]:
+        return ""
+
+    exp = expected.decode(errors='replace').split()
+    act = output.decode(errors='replace').split()
+    mismatches = numbers[0] if numbers is not None else token_mismatches(exp, act, comparator)
+    out_lines = [f'Token {idx + 1}: expected {exp[idx]}, got {act[idx]}' for idx in mismatches]
+    if len(exp) != len(act):
+        out_lines.append(f'Expected {len(exp)} tokens, got {len(act)}')
+    if len(out_lines) == 0:
+        return ""
+    return "\n".join(limit_lines(out_lines)) + "\n"
+
+# Matches every non-blank line of output against the pattern on the corresponding expected line
+def compare_regex_lines(expected, output):
+    exp = list(content_lines(output_stream(expected)))
+    act = list(content_lines(output_stream(output)))
+    out_lines = []
+    for exp_line, act_line in zip_longest(exp, act):
+        if exp_line is None:
+            out_lines.append(f'Line {act_line[0]}: unexpected line: {act_line[1]}')
+            continue
+        if act_line is None:
+            out_lines.append(f'Missing line matching /{exp_line[1]}/')
+            continue
+        try:
+            matched = re.fullmatch(exp_line[1], act_line[1]) is not None
+        except re.error as ex:
+            out_lines.append(f'Invalid pattern /{exp_line[1]}/ in expected output line {exp_line[0]}: {ex}')
+            continue
+        if not matched:
+            out_lines.append(f'Line {act_line[0]}: {act_line[1]}')
+            out_lines.append(f'    doesn\'t match /{exp_line[1]}/')
+    if len(out_lines) == 0:
+        return ""
+    return "\n".join(limit_lines(out_lines)) + "\n"
+
+# Comparators whose feedback is in diff's format
+diff_modes = ["diff", "case-insensitive"]
+
+# Compares output (bytes captured from the program) with the test's expected output
+# Returns empty string if they match, otherwise feedback on the differences
+def check_diff(case, output, comparator = default_comparator):
+    with profile_phase("check_diff", f'{case.qid}-{case.tid}'):
+        return compare_output(case, output, comparator)
+
+def compare_output(case, output, comparator = default_comparator):
+    try:
+        if comparator.mode not in diff_modes:
+            expected = case.read("output")
+            if comparator.mode == "regex-line":
+                str_return = compare_regex_lines(expected, output)
             else:
-                # If test id isn't found, stop searching
-                return test_ids
-    return test_ids
-
-def check_diff(qid, tid):
-    # Ensure program output file and expected output file exist
-    exp_out_file = f'{src_prefix}output-{qid}-{tid}'
-    if not os.path.isfile(exp_out_file):
-        err = f"{exp_out_file} doesn't exist. Cannot run diff."
-        print(err)
-        return err
-    if not os.path.isfile("program.output"):
-        err = "program.output doesn't exist. Cannot run diff."
-        print(err)
-        return err
-
-    # Construct argument string, combining all args and prefixing with '-'
-    arg_str = f'-{"".join(diff_args)}'
-    cmd = ['diff', f'{arg_str}', f'{exp_out_file}', 'program.output']
-    diff = subprocess.run(cmd, capture_output=True, text=True, timeout=test_timeout)
-
-    if diff.returncode == 0:
-        str_return = ""
-    elif diff.returncode == 1:
-        str_return = diff.stdout
-        str_return += diff.stderr
-    else:
+                str_return = compare_tokens(expected, output, comparator)
+            print(str_return)
+            return str_return
+
+        fold = comparator.mode == "case-insensitive"
+        if "output" in case.data:
+            exp_f = output_stream(case.data["output"])
+        else:
+            exp_f = open_output(case.files["output"])
+        with exp_f:
+            act_f = output_stream(output)
+            if outputs_match(exp_f, act_f, fold):
+                str_return = ""
+            else:
+                exp_f.seek(0)
+                act_f.seek(0)
+                str_return = diff_excerpt(exp_f, act_f, fold)
+    except OSError as ex:
         str_return = "Diff encountered an error!\n"
-        print(diff.stdout)
-        print(diff.stderr)
+        print(str(ex))
 
     print(str_return)
     return str_return
 
-def run_tests(current_test, qid, score_per_test):
-    # Get number of tests to run
-    test_ids = get_test_ids(qid)
-
-    for tid in test_ids:
-        print(f'\nRunning Q{qid}, Test{tid}...')
-
-        # Get program args
-        arg_filename = f'{src_prefix}args-{qid}-{tid}'
-        program_args = ""
-
+# Returns the Limits for a test: default_limits, overridden by the question's limits then the test's limits file.
+# A limits-I-J-XY file holds a JSON object with any of the Limits fields, e.g. {"cpu_time": 2, "memory": 268435456}
+def get_test_limits(case, question_limits = None):
+    limits = default_limits.merge(question_limits)
+    data = case.read("limits")
+    if data is not None:
         try:
-            with open(arg_filename) as f:
-                program_args = f.read().strip()
-        except:
-            print(f"Couldn't find arg file {arg_filename}")
-            pass
-
-        # Get program input
-        uses_input = False
-        input_filename = f'{src_prefix}input-{qid}-{tid}'
-        if os.path.isfile(input_filename):
-            uses_input = True
-
+            limits = limits.merge(Limits(**json.loads(data)))
+        except (ValueError, TypeError) as ex:
+            print(f'Ignoring invalid limits file for Q{case.qid} Test{case.tid}: {ex}')
+    return limits
+
+# Returns the Comparator for a test: default_comparator, overridden by the question's comparator then the
+# test's compare file. A compare-I-J-XY file holds a JSON object with any of the Comparator fields,
+# e.g. {"mode": "numeric", "abs_tol": 0.001}
+def get_test_comparator(case, question_comparator = None):
+    comparator = default_comparator.merge(question_comparator)
+    data = case.read("compare")
+    if data is not None:
         try:
-            if uses_input:
-                in_file = open(f'{input_filename}', 'r')
-                out_file = open(f'{program_output}', 'w')
-                err_file = open(f'{program_error}', 'a')
-                prog = subprocess.run([f'./{test_program}', f'{program_args}'],
-                                      stdin=in_file, stdout=out_file, stderr=err_file, timeout=test_timeout)
-                out_file.flush()
-                err_file.flush()
-            else:
-                out_file = open(f'{program_output}', 'w')
-                err_file = open(f'{program_error}', 'a')
-                prog = subprocess.run([f'./{test_program}', f'{program_args}'],
-                                      stdout=out_file, stderr=err_file, timeout=test_timeout)
-                out_file.flush()
-                err_file.flush()
-        except subprocess.TimeoutExpired:
-            feedback = f'Q{qid} Test{tid} program timed out after 5 seconds.'
-            current_test["output"] += feedback + "\n"
-            print(feedback)
-            continue
-
-        # Compare output with output-I-J-{tid}
-        feedback = check_diff(qid, tid)
+            comparator = comparator.merge(Comparator(**json.loads(data)))
+        except (ValueError, TypeError) as ex:
+            print(f'Ignoring invalid compare file for Q{case.qid} Test{case.tid}: {ex}')
+    return comparator
+
+# Feedback for a program stopped for exceeding one of its limits, or None if it wasn't
+def limit_feedback(prog, limits):
+    if prog.timed_out:
+        return f'program timed out after {limits.wall_time} seconds (wall-clock limit).'
+    if prog.limit_exceeded is not None:
+        limit = limits.output_size if prog.limit_exceeded == "stdout" else error_limit
+        return f'output limit exceeded: program wrote more than {limit} bytes to {prog.limit_exceeded} and was stopped.'
+    if prog.resource_limit == "cpu":
+        return f'program exceeded the CPU time limit of {limits.cpu_time} seconds.'
+    if prog.resource_limit == "memory":
+        return f'program exceeded the memory limit of {limits.memory / (1024 * 1024):g} MB.'
+    if prog.resource_limit == "file_size":
+        return f'program exceeded the file size limit of {limits.file_size} bytes.'
+    return None
+
+# Creates the working directory of one test program run, so files it writes can't clash with tests running
+# at the same time. It links to source/ and submission/, so relative paths such as source/data.txt resolve
+# as they do from the grader's own directory. Remove it with shutil.rmtree, which doesn't follow the links.
+def make_scratch_dir(prefix):
+    scratch_dir = tempfile.mkdtemp(prefix=prefix)
+    for name, target in [("source", src_prefix), ("submission", sub_prefix)]:
+        try:
+            os.symlink(os.path.abspath(target), os.path.join(scratch_dir, name))
+        except OSError:
+            pass
+    return scratch_dir
+
+# Runs a single functionality test inside its own scratch directory so that tests can run concurrently.
+# Output is captured in memory (up to the test's output_size limit and error_limit bytes).
+# Returns (score, feedback, timed_out) for the test, timed_out being True if it hit the wall-clock limit.
+def run_test_case(case, score_per_test, program_path, question_limits = None, question_comparator = None):
+    qid = case.qid
+    tid = case.tid
+    if budget_exhausted():
+        return budget_outcome(case)
+    print(f'\nRunning Q{qid}, Test{tid}...')
+
+    # Get program input
+    input_bytes = case.read("input")
+
+    limits = get_test_limits(case, question_limits)
+    scratch_dir = make_scratch_dir(f'test-{qid}-{tid}-')
+    try:
+        prog = run_captured(test_command(case, program_path), input_bytes, timeout=limits.wall_time,
+                            cwd=scratch_dir, stdout_limit=limits.output_size, limits=limits)
+        profiler.record_run("test", f'{qid}-{tid}', prog)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    return test_outcome(case, score_per_test, prog, limits, question_comparator)
+
+# Result of a test skipped because the time budget ran out. Like a wall-clock timeout it depends on how
+# busy the grader was, so it's reported as timed out and the question's result isn't cached.
+def budget_outcome(case):
+    feedback = f'Q{case.qid} Test{case.tid} skipped: the grading time limit of {time_budget} seconds ran out.'
+    print(feedback)
+    return 0, feedback + "\n", True
+
+# Returns the command running program_path with the test's arguments
+def test_command(case, program_path):
+    # Get program args
+    program_args = ""
+    args = case.read("args")
+    if args is not None:
+        program_args = args.decode(errors='replace').strip()
+    else:
+        print(f"Couldn't find arg file {src_prefix}args-{case.qid}-{case.tid}")
+    return [program_path, f'{program_args}']
+
+# Scores a finished test run prog, comparing its output with the expected output.
+# Returns (score, feedback, timed_out) for the test.
+def test_outcome(case, score_per_test, prog, limits, question_comparator = None):
+    qid = case.qid
+    tid = case.tid
+    feedback = limit_feedback(prog, limits)
+    if feedback is not None:
+        feedback = f'Q{qid} Test{tid} {feedback}'
+        print(feedback)
+        return 0, feedback + "\n", prog.timed_out
+
+    # Compare output with output-I-J-{tid}
+    comparator = get_test_comparator(case, question_comparator)
+    feedback = check_diff(case, prog.stdout, comparator)
 
-        score = 0
-        # A return code of 0 means program terminated successfully w/o issue
-        if prog.returncode == 0:
-            if len(feedback) != 0:
-                print(f'Q{qid}, Test{tid} failed!')
-                score = 0
-                pre = f'\nQ{qid} Test{tid} failed!\n'
+    score = 0
+    # A return code of 0 means program terminated successfully w/o issue
+    if prog.returncode == 0:
+        if len(feedback) != 0:
+            print(f'Q{qid}, Test{tid} failed!')
+            score = 0
+            pre = f'\nQ{qid} Test{tid} failed!\n'
+            if comparator.mode in diff_modes:
                 pre += "\n< EXPECTED-OUTPUT\n---\n> YOUR-OUTPUT\n\n===Begin diff output===\n"
                 feedback = pre + feedback
                 feedback += "====End diff output====\n"
             else:
-                score = score_per_test
-                feedback = f'Q{qid} Test{tid} Passed. +{score_per_test} marks\n'
-                print(f'Q{qid}, Test{tid} passed.')
+                pre += f'\nOutput compared with the {comparator.mode} comparator.\n\n===Begin comparison output===\n'
+                feedback = pre + feedback
+                feedback += "====End comparison output====\n"
         else:
-            error_msg = f'Program exit status != 0 (program returned POSIX status code {prog.returncode * -1}): abnormal termination of program (possibly a segmentation fault or timeout).'
-            print(error_msg)
-            feedback += error_msg + "\n"
-            try:
-                err_file = open(f'{program_error}', 'r')
-                error = err_file.read()
-                print(error)
-            except:
-                print(f'Failed to open {program_error}.')
+            score = score_per_test
+            feedback = f'Q{qid} Test{tid} Passed. +{score_per_test} marks\n'
+            print(f'Q{qid}, Test{tid} passed.')
+    else:
+        error_msg = f'Program exit status != 0 (program returned POSIX status code {prog.returncode * -1}): abnormal termination of program (possibly a segmentation fault or timeout).'
+        print(error_msg)
+        feedback += error_msg + "\n"
+        print(prog.stderr.decode(errors='replace'))
+
+    return score, feedback, False
+
+# ===============================
+#       Performance tests
+# ===============================
+# Each size n of a PerformanceTest runs the test driver with args (e.g. "{size}" -> "1000") and, if
+# source/perf-I-J-NAME-n exists, that file as stdin. The output isn't checked, only that the program
+# exits normally within its limits. Each size is run warmup times, then trials times, and the smallest
+# CPU time (user + sys) is its measurement: CPU time isn't inflated by waiting for other processes, and
+# the fastest trial is the one least disturbed by a busy host. Performance tests are run one at a time,
+# and hold every process slot while they're measured so that no other test or compile competes with them
+# for the CPU. Sizes should be chosen so that even the smallest takes at
+# least 10ms or so, below that measurements are mostly timer resolution.
+
+# Log of the cost of each complexity class for input size n. Growth is compared by fitting the slope of
+# log(time) against log(n), which is 1 for "n", 2 for "n^2", a little over 1 for "n log n" and so on.
+complexity_classes = {
+    "1": lambda n: 0.0,
+    "log n": lambda n: math.log(math.log(n)),
+    "n": lambda n: math.log(n),
+    "n log n": lambda n: math.log(n) + math.log(math.log(n)),
+    "n^2": lambda n: 2 * math.log(n),
+    "n^3": lambda n: 3 * math.log(n),
+    "2^n": lambda n: n * math.log(2)
+}
+
+perf_min_time = 0.001               # Measurements are clamped to at least this many seconds (rusage resolution)
+perf_min_growth_time = 0.01         # Largest size must take at least this long for its growth rate to be measured
+_perf_lock = threading.Lock()
+
+# Holds every process slot, waiting for running programs to finish first. Programs run inside it must
+# pass hold_slot=False to run_captured.
+class exclusive_processes:
+    def __enter__(self):
+        # Only one thread at a time collects slots, otherwise two could each hold some and wait forever
+        _perf_lock.acquire()
+        for _ in range(_process_slot_count):
+            _process_slots.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        for _ in range(_process_slot_count):
+            _process_slots.release()
+        _perf_lock.release()
+        return False
+
+# Least squares slope of ys against xs
+def fit_slope(xs, ys):
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if variance == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+# Slope of complexity class name over sizes, in the same log-log terms as the measurements
+def class_slope(name, sizes):
+    return fit_slope([math.log(n) for n in sizes], [complexity_classes[name](n) for n in sizes])
+
+# Runs size of perf with the program at program_path.
+# Returns (CPU time of the fastest trial, None), or (None, reason) if the program didn't finish normally.
+def measure_size(perf, qid, size, program_path, limits):
+    cmd = [program_path, perf.args.format(size=size)]
+    input_bytes = None
+    input_path = src_prefix + perf.input_name(qid, size)
+    if os.path.isfile(input_path):
+        with open(input_path, 'rb') as f:
+            input_bytes = f.read()
+
+    times = []
+    scratch_dir = make_scratch_dir(f'perf-{qid}-')
+    try:
+        for trial in range(perf.warmup + perf.trials):
+            if budget_exhausted():
+                return None, f'not measured, the grading time limit of {time_budget} seconds ran out.'
+            prog = run_captured(cmd, input_bytes, timeout=limits.wall_time, cwd=scratch_dir,
+                                stdout_limit=limits.output_size, limits=limits, hold_slot=False)
+            profiler.record_run("performance", f'{qid}-{perf.name}-{size}', prog)
+            reason = limit_feedback(prog, limits)
+            if reason is None and prog.returncode != 0:
+                reason = f'program exited with status {prog.returncode}.'
+            if reason is not None:
+                return None, reason
+            if trial >= perf.warmup:
+                times.append(prog.user_time + prog.sys_time)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    return max(min(times), perf_min_time), None
+
+# Measures perf and adds its score and the measurements to current_test
+def run_performance_test(current_test, q, perf, program_path):
+    qid = q.qid
+    limits = default_limits.merge(q.limits)
+    print(f'\nRunning Q{qid} performance test {perf.name}...')
+
+    lines = [f'Q{qid} performance test {perf.name} (CPU time of the fastest of {perf.trials} runs):']
+    measured = []
+    failure = None
+    with exclusive_processes():
+        for size in perf.sizes:
+            cpu_time, failure = measure_size(perf, qid, size, program_path, limits)
+            if failure is not None:
+                lines.append(f'  n={size}: {failure}')
+                break
+            measured.append((size, cpu_time))
+            lines.append(f'  n={size}: {cpu_time:.3f}s')
 
+    score = 0
+    if perf.max_cpu_time is not None:
+        if failure is None and measured[-1][1] <= perf.max_cpu_time:
+            score += perf.time_points
+            lines.append(f'  Largest input ran within the time limit of {perf.max_cpu_time}s. '
+                         f'+{perf.time_points} marks')
+        else:
+            lines.append(f'  Largest input did not run within the time limit of {perf.max_cpu_time}s.')
+
+    if perf.complexity is not None:
+        # Clamped measurements are only timer resolution, fitting them would make any algorithm look flat
+        fitted = [(n, t) for n, t in measured if t > perf_min_time]
+        if failure is not None or len(measured) < 2:
+            lines.append(f'  Growth rate could not be measured, every input size must run successfully.')
+        elif len(fitted) < 2 or max(t for _, t in fitted) < perf_min_growth_time:
+            lines.append(f'  Growth rate could not be measured, the inputs ran too quickly to time '
+                         f'(the largest must take at least {perf_min_growth_time}s).')
+        else:
+            sizes = [n for n, _ in fitted]
+            slope = fit_slope([math.log(n) for n in sizes], [math.log(t) for _, t in fitted])
+            best = min(complexity_classes, key=lambda name: abs(class_slope(name, sizes) - slope))
+            lines.append(f'  Running time grows like n^{max(slope, 0.0):.2f}, closest to O({best}).')
+            if slope <= class_slope(perf.complexity, sizes) + perf.tolerance:
+                score += perf.complexity_points
+                lines.append(f'  Meets the expected complexity of O({perf.complexity}). '
+                             f'+{perf.complexity_points} marks')
+            else:
+                lines.append(f'  Grows faster than the expected complexity of O({perf.complexity}).')
+
+    feedback = "\n".join(lines) + "\n"
+    print(feedback)
+    current_test["score"] += score
+    current_test["output"] += feedback
+
+def run_performance_tests(current_test, q, program_path):
+    # Timings depend on how busy the grader was, so like a wall-clock timeout the result shouldn't be reused
+    if len(q.perf_tests) != 0:
+        current_test["cacheable"] = False
+    for perf in q.perf_tests:
+        run_performance_test(current_test, q, perf, program_path)
+
+# Runs every functionality test for question qid on a bounded worker pool.
+# Results are merged back into current_test in test id order, so feedback is identical to a serial run.
+# batched runs the tests through a single batched driver process first.
+def run_tests(current_test, qid, score_per_test, workers = None, program = test_program, limits = None,
+              batched = False, comparator = None):
+    # Get tests to run
+    cases = get_test_cases(qid)
+    program_path = os.path.abspath(program)
+
+    if workers is None:
+        workers = test_workers
+    results = [None] * len(cases)
+    if batched:
+        results = run_batched_driver(cases, score_per_test, program_path, limits, comparator)
+
+    # Tests without a result from the batched driver each run in their own process
+    remaining = [idx for idx, result in enumerate(results) if result is None]
+    separate = run_pool(lambda idx: run_test_case(cases[idx], score_per_test, program_path, limits, comparator),
+                        remaining, workers)
+    for idx, result in zip(remaining, separate):
+        results[idx] = result
+    record_test_results(current_test, results)
+
+# Adds (score, feedback, timed_out) of each test to current_test
+def record_test_results(current_test, results):
+    for score, feedback, timed_out in results:
         current_test["score"] += score
         current_test["output"] += feedback
+        # A wall-clock timeout depends on how busy the grader was, so the result shouldn't be reused
+        if timed_out:
+            current_test["cacheable"] = False
+
+# ===============================
+#     Batched test drivers
+# ===============================
+# Starting a process per test dominates the grading time of questions with hundreds of small tests.
+# A batched driver runs them all in one process: it's started as "program.out --batched NONCE" and reads
+# tests from stdin until end of input, each framed as
+#     <tid> <args length> <input length>\n<args><input>
+# For each test it writes its output to stdout framed as
+#     <NONCE> <tid> <output length>\n<output>
+# e.g. by pointing std::cout/std::cin at string streams while it runs the test, flushing after each frame.
+# Lengths are in bytes. NONCE is random for every run, so output printed by the code being tested can't
+# pass for a frame. Frames are read until the first thing that isn't one. A frame for a test that wasn't
+# sent, or for one that was already answered, discards the whole batch and every test runs separately.
+# The batch runs with the question's limits for a single test, which cover all of its tests together.
+# If it's stopped by a limit (e.g. by one slow test), every test it hadn't answered yet is run separately
+# with its own limits, so only the slow test gets limit feedback.
+
+# Returns the framed stdin of a batched driver running cases
+def batched_driver_input(cases):
+    frames = []
+    for case in cases:
+        args = case.read("args") or b""
+        input_bytes = case.read("input") or b""
+        args = args.strip()
+        frames += [f'{case.tid} {len(args)} {len(input_bytes)}\n'.encode(), args, input_bytes]
+    return b"".join(frames)
+
+# Splits framed output of a batched driver into {tid: output}, stopping at the first incomplete or malformed
+# frame or one without nonce (bytes). Raises ValueError for a frame whose test id isn't in tids or is repeated.
+def parse_batched_output(data, nonce, tids):
+    outputs = {}
+    pos = 0
+    while pos < len(data):
+        end = data.find(b"\n", pos)
+        if end == -1:
+            break
+        header = data[pos:end].split()
+        if len(header) != 3 or header[0] != nonce or not header[2].isdigit():
+            break
+        start = end + 1
+        size = int(header[2])
+        if start + size > len(data):
+            break
+        tid = header[1].decode(errors='replace')
+        if tid not in tids:
+            raise ValueError(f'output for unknown test {tid}')
+        if tid in outputs:
+            raise ValueError(f'output for test {tid} more than once')
+        outputs[tid] = data[start:start + size]
+        pos = start + size
+    return outputs
+
+# Runs cases through one batched driver process.
+# Returns list of (score, feedback, timed_out) for each case, or None for cases that must run separately:
+# those with their own limits file, any whose output wasn't received because the driver crashed, hit a
+# limit or wrote something that isn't a frame, and every case if the driver broke the protocol. A driver
+# that doesn't support batching is therefore graded as if it had been run per test.
+def run_batched_driver(cases, score_per_test, program_path, question_limits = None, question_comparator = None):
+    results = [None] * len(cases)
+    batch = [idx for idx, case in enumerate(cases) if "limits" not in case.files]
+    if len(batch) == 0:
+        return results
+
+    qid = cases[batch[0]].qid
+    # Left to run_test_case, which reports each test as skipped
+    if budget_exhausted():
+        return results
+    print(f'\nRunning {len(batch)} Q{qid} tests with a batched driver...')
+    limits = default_limits.merge(question_limits)
+    nonce = os.urandom(8).hex()
+    scratch_dir = make_scratch_dir(f'batch-{qid}-')
+    try:
+        prog = run_captured([program_path, batched_driver_flag, nonce],
+                            batched_driver_input([cases[idx] for idx in batch]), timeout=limits.wall_time,
+                            cwd=scratch_dir, stdout_limit=min(limits.output_size * len(batch), batched_output_limit),
+                            limits=limits)
+        profiler.record_run("batched_driver", qid, prog)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
 
-    silent_cleanup()
+    try:
+        outputs = parse_batched_output(prog.stdout, nonce.encode(), {cases[idx].tid for idx in batch})
+    except ValueError as ex:
+        print(f'Batched driver for Q{qid} wrote {ex}, running every test separately.')
+        return results
+    for idx in batch:
+        output = outputs.get(cases[idx].tid)
+        # An oversized output is rerun so that it gets the usual output limit feedback
+        if output is None or len(output) > limits.output_size:
+            continue
+        run = ProgramRun()
+        run.returncode = 0
+        run.stdout = output
+        results[idx] = test_outcome(cases[idx], score_per_test, run, limits, question_comparator)
+
+    missing = sum(1 for idx in batch if results[idx] is None)
+    if missing != 0:
+        print(f'Batched driver for Q{qid} stopped early (status {prog.returncode}), '
+              f'running {missing} remaining tests separately.')
+    return results
+
+# Accumulates a question's feedback as a list of strings that's joined once, when the question is done.
+# Feedback past limit bytes is cut at a line boundary and the remaining lines are only counted, so a
+# submission that fails every test with large diffs still gets a small results.json.
+# Supports += so it can be used in place of the feedback string.
+class FeedbackBuffer:
+    def __init__(self, limit = None):
+        self.parts = []
+        self.size = 0
+        self.limit = feedback_limit if limit is None else limit
+        self.full = False
+        self.omitted = 0                # Lines dropped once the buffer was full
+
+    def __iadd__(self, text):
+        self.append(text)
+        return self
+
+    def append(self, text):
+        if not self.full:
+            data = text.encode(errors='replace')
+            if self.size + len(data) <= self.limit:
+                self.parts.append(text)
+                self.size += len(data)
+                return
+            # Keep the whole lines that fit
+            self.full = True
+            kept = data[:self.limit - self.size].decode(errors='ignore')
+            kept = kept[:kept.rfind("\n") + 1]
+            self.parts.append(kept)
+            self.size += len(kept.encode(errors='replace'))
+            text = text[len(kept):]
+        self.omitted += len(text.splitlines())
+
+    def __str__(self):
+        if not self.full:
+            return "".join(self.parts)
+        return "".join(self.parts) + f'... {self.omitted} more lines of feedback not shown\n'
+
+# Writes result_json to path one test at a time, rather than encoding it as a single string.
+# The file is identical to json.dump's output. It's written to a temporary file that replaces path,
+# so path always holds complete results even if grading is killed part way through writing it.
+def write_results(result_json, path):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        write_results_file(result_json, fd)
+        os.replace(tmp_path, path)
+    except BaseException:
+        silent_remove(tmp_path)
+        raise
+
+def write_results_file(result_json, fd):
+    with os.fdopen(fd, 'w') as f:
+        for idx, (key, value) in enumerate(result_json.items()):
+            f.write(("{" if idx == 0 else ", ") + json.dumps(key) + ": ")
+            if key != "tests":
+                json.dump(value, f)
+                continue
+            f.write("[")
+            for test_idx, test in enumerate(value):
+                if test_idx != 0:
+                    f.write(", ")
+                json.dump(test, f)
+            f.write("]")
+        f.write("}" if len(result_json) != 0 else "{}")
 
 
 def record_test(result_json, test_score, max_score, name, feedback, visibility = "visible"):
@@ -386,7 +1967,18 @@ def apply_cap(meta_test, meta_data, cur_score, participation_only = False, parti
 
     return capped_score
 
-def apply_late_penalty(meta_test, meta_data, cur_score):
+# Timezone that submission times are shown in. zoneinfo is only in the standard library from Python 3.9
+# (and needs the system's timezone database), otherwise pytz is used.
+@lru_cache(maxsize=None)
+def local_timezone():
+    try:
+        from zoneinfo import ZoneInfo
+        return ZoneInfo('Australia/Adelaide')
+    except (ImportError, KeyError):
+        from pytz import timezone
+        return timezone('Australia/Adelaide')
+
+def apply_late_penalty(meta_test, meta_data, cur_score, quiet = False):
     score = cur_score
 
     orig_due_time = datetime.fromisoformat(meta_data['assignment']['due_date'])
@@ -395,15 +1987,17 @@ def apply_late_penalty(meta_test, meta_data, cur_score):
     for user in users:
         cur_due_time = datetime.fromisoformat(user['assignment']['due_date'])
         if cur_due_time > latest_due_time:
-            local_time = cur_due_time.astimezone(timezone('Australia/Adelaide'))
-            print(f"Later due time (extension) found for user {user['name']} of {local_time}, instead of original due date: {orig_due_time.astimezone(timezone('Australia/Adelaide'))}")
+            local_time = cur_due_time.astimezone(local_timezone())
+            if not quiet:
+                print(f"Later due time (extension) found for user {user['name']} of {local_time}, instead of original due date: {orig_due_time.astimezone(local_timezone())}")
             latest_due_time = cur_due_time
 
     sub_time = datetime.fromisoformat(meta_data['created_at'])
     max_grade = float(meta_data['assignment']['total_points'])
     lateness = sub_time - latest_due_time
     if lateness > timedelta(0):
-        print(f'Late submission, up to {1+math.ceil(lateness.days)} days late')
+        if not quiet:
+            print(f'Late submission, up to {1+math.ceil(lateness.days)} days late')
         # Cap is 25% per days late
         # cap_percent starts at 0.75 then decreases by 0.25 per FULL day after that
         # This is because if lateness > 0, then submission is "up to" 1 day late
@@ -420,7 +2014,7 @@ def apply_late_penalty(meta_test, meta_data, cur_score):
         score = new_score
     return score
 
-def check_previous(meta_test, meta_data, cur_score):
+def check_previous(meta_test, meta_data, cur_score, quiet = False):
     # Check previous submissions and use highest grade
     prev_subs = meta_data["previous_submissions"]
     best_score = cur_score
@@ -434,99 +2028,643 @@ def check_previous(meta_test, meta_data, cur_score):
     # If better score found, best_date will contain time of submission
     if best_date != "":
         sub_time = datetime.fromisoformat(best_date)
-        local_time = sub_time.astimezone(timezone('Australia/Adelaide'))
-        print(f'Better submission found with grade: {best_score}')
-        print(f'Better submission from time: {local_time} (Adelaide time)')
+        local_time = sub_time.astimezone(local_timezone())
+        if not quiet:
+            print(f'Better submission found with grade: {best_score}')
+            print(f'Better submission from time: {local_time} (Adelaide time)')
         meta_test["output"] += f'Better submission found with grade: {best_score}.\n'
         meta_test["output"] += f'Better submission from time: {best_date} (Adelaide time)\n'
     return best_score
 
-def run_questions(questions, participation_only = False, participation_grade = 1):
-    meta_data = {}
-    try:
-        md = open('submission_metadata.json')
-        meta_data = json.load(md)
-    except BaseException as ex:
-        print(f'An error occured when trying to open submission_metadata.json')
-        print(str(ex))
-
-    result_json = {'score': 0, 'visibility': 'visible', 'stdout_visibility': 'hidden', 'tests': []}
+# Grades a single question inside its own workspace directory and returns its current_test dictionary
+# objects contains translation units already compiled by build_objects
+def grade_question(q, objects = None):
+    with profile_phase("question", q.qid):
+        current_test = grade_question_tests(q, objects)
+    current_test["output"] = str(current_test["output"])
+    return current_test
 
-    # ===============================
-    #       Run Question tests
-    # ===============================
-    for q in questions:
-        silent_remove(f'{test_program}')
+def grade_question_tests(q, objects):
+    qid = q.qid
 
-        qid = q.qid
+    f_points = q.f_points
 
-        req_file_names = set()
-        for test in q.compile_tests:
-            for cur_file in test.submitted_files:
-                req_file_names.add(cur_file)
+    current_test = {
+        "score": 0,
+        "max_score": 0,
+        "name": f'Q{qid}',
+        "output": FeedbackBuffer()
+    }
 
-        for cur_file in q.extra_files:
-            req_file_names.add(cur_file)
-        f_points = q.f_points
+    print(f'\n==================')
+    print(f'      Q{qid}      ')
+    print(f'==================')
 
-        # Of the required files, move any header files from submission to source to ensure test drivers can compile
-        for cur_file in req_file_names:
-            components = cur_file.split('.')
-            ext = components[-1]
+    workspace = tempfile.mkdtemp(prefix=f'q{qid}-')
+    program = os.path.join(workspace, test_program)
+    try:
+        # If failed, skip question because won't compile
+        missing_files = check_present(current_test, q.get_required_files(), f_points)
 
-            try:
-                if ext == "h" or ext == 'hpp':
-                    print(f'\n========= Header file required: {cur_file}')
-                    # Don't overwrite file if it exists
-                    if not os.path.isfile(src_prefix + cur_file):
-                        print(f'Attempting to move {sub_prefix + cur_file} to {src_prefix + cur_file} to ensure test drivers can compile.')
-                        shutil.copyfile(sub_prefix + cur_file, src_prefix + cur_file)
-                    else:
-                        print(f'{src_prefix + cur_file} already exists. Not moving as it will overwrite existing file.')
-            except BaseException as ex:
-                print(f'An error occured when trying to move required files.')
-                print(str(ex))
-                continue
+        # Every target is linked from shared objects. The tester's program is kept for the
+        # functionality tests, other programs are only built to award compile marks.
+        tester_idx = q.get_tester_idx()
 
-        current_test = {
-            "score": 0,
-            "max_score": 0,
-            "name": f'Q{qid}',
-            "output": ""
-        }
+        compiled = False
+        other_program = os.path.join(workspace, "compile-test.out")
+        for idx, compile_test in enumerate(q.compile_tests):
+            if idx == tester_idx:
+                compiled = check_compile_target(current_test, compile_test.points, compile_test, program, objects)
+            else:
+                check_compile_target(current_test, compile_test.points, compile_test, other_program, objects,
+                                     check_only_compiles)
+                silent_remove(other_program)
 
-        print(f'\n==================')
-        print(f'      Q{qid}      ')
-        print(f'==================')
+        # If test driver didn't successfully compile, don't run tests
+        if not compiled:
+            print()
+            print(f'Q{qid} functionality tests skipped due to test driver failing to compile.')
+            print()
+            return current_test
 
-        # If failed, skip question because won't compile
-        missing_files = check_present(current_test, list(req_file_names), f_points)
+        # Run tests
+        run_tests(current_test, qid, q.test_points, program=program, limits=q.limits, batched=q.batched_driver,
+                  comparator=q.comparator)
+        run_performance_tests(current_test, q, os.path.abspath(program))
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    sys.stdout.flush()
+    return current_test
+
+# ===============================
+#        Asyncio pipeline
+# ===============================
+# Alternative to the thread pool engine (see async_engine). Every translation unit starts compiling at once,
+# and each question links and tests its programs as soon as the objects it needs are ready, so compiling,
+# running and comparing overlap across questions. Each stage has its own concurrency limit, and timeouts
+# cancel the waiting coroutine instead of blocking a thread. Feedback is recorded in the same order as the
+# thread pool engine, so result_json is identical.
+
+# Concurrency limit of each pipeline stage, created inside the running event loop
+class PipelineStages:
+    def __init__(self):
+        import asyncio
+        self.sizes = {"compile": pool_size(compile_workers), "run": pool_size(test_workers),
+                      "compare": pool_size(test_workers)}
+        self.compile = asyncio.Semaphore(self.sizes["compile"])
+        self.run = asyncio.Semaphore(self.sizes["run"])
+        self.compare = asyncio.Semaphore(self.sizes["compare"])
+        self.exclusive = asyncio.Lock()
+        # Translation units compiled up front queue here, see compile_unit_async
+        self.units = asyncio.Semaphore(self.sizes["compile"])
+
+    # Takes every slot of every stage, so nothing else in the pipeline runs while performance tests are
+    # measured. Only one question at a time collects them, so two can't each hold some and wait forever.
+    async def acquire_all(self):
+        await self.exclusive.acquire()
+        for name, size in self.sizes.items():
+            for _ in range(size):
+                await getattr(self, name).acquire()
+
+    def release_all(self):
+        for name, size in self.sizes.items():
+            for _ in range(size):
+                getattr(self, name).release()
+        self.exclusive.release()
+
+# Reads stream into chunks, stopping proc once more than limit bytes (None for no limit) have been read
+async def read_stream(proc, stream, name, limit, chunks, result):
+    size = 0
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            return
+        if limit is None:
+            chunks.append(data)
+            continue
+        chunks.append(data[:max(0, limit - size)])
+        size += len(data)
+        if size > limit:
+            if result.limit_exceeded is None:
+                result.limit_exceeded = name
+            kill_group(proc)
+            return
+
+# Writes data to stream then closes it, the program may exit without reading all of it
+async def feed_stream(stream, data):
+    try:
+        stream.write(data)
+        await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        stream.close()
+
+# Runs func(*args) on a worker thread, so blocking file I/O doesn't hold up the event loop
+async def run_in_thread(func, *args):
+    import asyncio
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, func, *args)
+
+# Coroutine equivalent of run_captured, using asyncio.create_subprocess_exec
+async def run_captured_async(cmd, input_bytes = None, timeout = test_timeout, cwd = None,
+                             stdout_limit = output_limit, stderr_limit = error_limit, limits = None):
+    import asyncio
+    result = ProgramRun()
+    cmd, preexec_fn = limited_command(cmd, limits)
+
+    start = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                stdin=subprocess.DEVNULL if input_bytes is None else subprocess.PIPE,
+                                                start_new_session=True, preexec_fn=preexec_fn)
+    out_chunks = []
+    err_chunks = []
+    tasks = [read_stream(proc, proc.stdout, "stdout", stdout_limit, out_chunks, result),
+             read_stream(proc, proc.stderr, "stderr", stderr_limit, err_chunks, result),
+             proc.wait()]
+    if input_bytes is not None:
+        tasks.append(feed_stream(proc.stdin, input_bytes))
+    try:
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+    except asyncio.TimeoutError:
+        result.timed_out = True
+    finally:
+        # Also stops any children the program forked
+        kill_group(proc)
+    await proc.wait()
+    result.wall_time = time.monotonic() - start
+
+    result.returncode = proc.returncode
+    result.stdout = b"".join(out_chunks)
+    result.stderr = b"".join(err_chunks)
+    if not result.timed_out and result.limit_exceeded is None:
+        result.resource_limit = limit_verdict(result, limits)
+    return result
+
+async def run_compiler_async(cmd, stages):
+    async with stages.compile:
+        print(" ".join(cmd))
+        run = await run_captured_async(cmd, timeout=compile_timeout, stdout_limit=None, stderr_limit=None)
+    return compiler_result(cmd, run)
+
+# Coroutine equivalent of compile_object
+async def compile_object_async(path, build_dir, check_only, stages):
+    flags = check_only_flags if check_only else compile_flags
+    if compile_cache_enabled():
+        try:
+            return await compile_cached_object_async(path, flags, stages)
+        except OSError as ex:
+            print(f'Compile cache unavailable ({ex}), compiling {path} without cache.')
+    return await compile_uncached_object_async(path, build_dir, flags, stages)
+
+async def compile_uncached_object_async(path, build_dir, flags, stages):
+    obj_path = build_object_path(path, build_dir, flags)
+    compiler_process = await run_compiler_async(compiler_cmd('-c', path, '-o', obj_path, flags=flags), stages)
+    if compiler_process.returncode != 0:
+        return None, compiler_process
+    return obj_path, None
+
+async def compile_cached_object_async(path, flags, stages):
+    preprocess = await run_compiler_async(compiler_cmd('-E', '-P', path, flags=flags), stages)
+    if preprocess.returncode != 0:
+        return None, preprocess
+
+    obj_path = object_cache_entry(flags, preprocess.stdout)
+    if await run_in_thread(cache_lookup, obj_path):
+        print(f'Using cached object for {path}')
+        return obj_path, None
+
+    tmp_path = await run_in_thread(cache_tmp_path, "objects")
+    try:
+        compiler_process = await run_compiler_async(compiler_cmd('-c', path, '-o', tmp_path, flags=flags), stages)
+        if compiler_process.returncode != 0:
+            return None, compiler_process
+        # Storing also evicts old entries, which walks the whole cache
+        await run_in_thread(cache_store, tmp_path, obj_path)
+    finally:
+        await run_in_thread(silent_remove, tmp_path)
+    return obj_path, None
+
+# Coroutine equivalent of link_objects
+async def link_objects_async(obj_paths, program, stages):
+    if compile_cache_enabled():
+        try:
+            return await link_cached_program_async(obj_paths, program, stages)
+        except OSError as ex:
+            print(f'Compile cache unavailable ({ex}), linking {program} without cache.')
+            silent_remove(program)
+    linker_process = await run_compiler_async(compiler_cmd('-o', program, *obj_paths), stages)
+    if linker_process.returncode != 0:
+        return linker_process
+    return None
+
+async def link_cached_program_async(obj_paths, program, stages):
+    program_path = program_cache_entry(obj_paths)
+    if await run_in_thread(cache_lookup, program_path):
+        print(f'Using cached program for objects {" ".join(os.path.basename(p) for p in obj_paths)}')
+    else:
+        tmp_path = await run_in_thread(cache_tmp_path, "programs")
+        try:
+            linker_process = await run_compiler_async(compiler_cmd('-o', tmp_path, *obj_paths), stages)
+            if linker_process.returncode != 0:
+                return linker_process
+            await run_in_thread(cache_store, tmp_path, program_path)
+        finally:
+            await run_in_thread(silent_remove, tmp_path)
+    await run_in_thread(shutil.copy2, program_path, program)
+    return None
+
+# Compiles a translation unit shared through the objects of grade_questions_async. Every unit is queued at
+# once, so they wait for a slot of their own and check the time budget when they're about to start.
+# Returns None if it ran out first.
+async def compile_unit_async(path, build_dir, check_only, stages):
+    async with stages.units:
+        if budget_exhausted():
+            return None
+        return await compile_object_async(path, build_dir, check_only, stages)
+
+# Coroutine equivalent of build_program, objects maps source paths to their compile tasks
+async def build_program_async(file_paths, program, objects, check_only, stages):
+    import asyncio
+    build_dir = os.path.dirname(os.path.abspath(program))
+    pending = []
+    for path in file_paths:
+        if is_header(path):
+            continue
+        if path in objects:
+            # Shielded so that a cancelled question can't cancel a compile other questions share
+            pending.append(asyncio.shield(objects[path]))
+        else:
+            pending.append(compile_object_async(path, build_dir, check_only, stages))
+    built = await asyncio.gather(*pending)
+    if any(result is None for result in built):
+        return None
+
+    # Objects evicted from the compile cache by another grader since they were compiled are rebuilt
+    flags = check_only_flags if check_only else compile_flags
+    sources = [path for path in file_paths if not is_header(path)]
+    for idx, (path, (obj_path, _)) in enumerate(zip(sources, built)):
+        if obj_path is not None and not os.path.exists(obj_path):
+            built[idx] = await compile_uncached_object_async(path, build_dir, flags, stages)
+
+    obj_paths = [obj_path for obj_path, _ in built]
+    failures = [failure for _, failure in built if failure is not None]
+    if len(failures) == 0:
+        failure = await link_objects_async(obj_paths, program, stages)
+        if failure is not None:
+            failures.append(failure)
+    return build_result(file_paths, failures)
+
+async def build_target_async(compile_test, program, objects, check_only, stages):
+    file_names = compile_test.get_file_names()
+    print(f'Compiling {test_program} using files: {" ".join(file_names)}...')
+    start = time.monotonic()
+    compiler_process = await build_program_async(compile_test.get_file_paths(), program, objects, check_only, stages)
+    profiler.record("check_compile_target", " ".join(file_names), time.monotonic() - start)
+    return compiler_process
+
+# Coroutine equivalent of run_test_case. The output is compared on a worker thread,
+# so other tests keep running while a large output is being diffed.
+async def run_test_case_async(case, score_per_test, program_path, question_limits, question_comparator, stages):
+    import asyncio
+    if budget_exhausted():
+        return budget_outcome(case)
+    print(f'\nRunning Q{case.qid}, Test{case.tid}...')
+    limits = get_test_limits(case, question_limits)
+    scratch_dir = await run_in_thread(make_scratch_dir, f'test-{case.qid}-{case.tid}-')
+    try:
+        async with stages.run:
+            prog = await run_captured_async(test_command(case, program_path), case.read("input"),
+                                            timeout=limits.wall_time, cwd=scratch_dir,
+                                            stdout_limit=limits.output_size, limits=limits)
+        profiler.record_run("test", f'{case.qid}-{case.tid}', prog)
+    finally:
+        await run_in_thread(shutil.rmtree, scratch_dir, True)
+
+    async with stages.compare:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, test_outcome, case, score_per_test, prog, limits, question_comparator)
+
+# Coroutine equivalent of grade_question_tests.
+# Like grade_pending, returns None without recording anything if none of q's files were compiled before
+# the time budget ran out and out_of_time() is True.
+async def grade_question_async(q, objects, stages, out_of_time = None):
+    import asyncio
+    qid = q.qid
+    start = time.monotonic()
+
+    current_test = {
+        "score": 0,
+        "max_score": 0,
+        "name": f'Q{qid}',
+        "output": FeedbackBuffer()
+    }
 
-        compiled = False
-        for compile_test in q.compile_tests:
-            compiled = check_compile_target(current_test, compile_test.points, compile_test)
-            silent_remove(f'{test_program}')
+    print(f'\n==================')
+    print(f'      Q{qid}      ')
+    print(f'==================')
 
+    workspace = tempfile.mkdtemp(prefix=f'q{qid}-')
+    program = os.path.join(workspace, test_program)
+    try:
+        check_present(current_test, q.get_required_files(), q.f_points)
+
+        # Every target is built concurrently, then recorded in order
+        tester_idx = q.get_tester_idx()
+        targets = []
+        for idx, compile_test in enumerate(q.compile_tests):
+            if idx == tester_idx:
+                targets.append(build_target_async(compile_test, program, objects, False, stages))
+            else:
+                other_program = os.path.join(workspace, f'compile-test-{idx}.out')
+                targets.append(build_target_async(compile_test, other_program, objects, check_only_compiles, stages))
+        built = await asyncio.gather(*targets)
+        if (out_of_time is not None and all(objects[path].result() is None for path in translation_units([q]))
+                and out_of_time()):
+            return None
 
-        # Separately compile test driver
-        if len(q.compile_tests) != 0:
-            idx = q.tester_idx
-            compiled = check_compile_target(None, 0, q.compile_tests[idx])
+        compiled = False
+        for idx, (compile_test, compiler_process) in enumerate(zip(q.compile_tests, built)):
+            if idx == tester_idx:
+                compiled = record_compile(current_test, compile_test.points, compile_test, program, compiler_process)
+            else:
+                other_program = os.path.join(workspace, f'compile-test-{idx}.out')
+                record_compile(current_test, compile_test.points, compile_test, other_program, compiler_process)
+                silent_remove(other_program)
 
-        # If test driver didn't successfully compile, don't run tests
         if not compiled:
             print()
             print(f'Q{qid} functionality tests skipped due to test driver failing to compile.')
             print()
-            record_test(result_json, current_test["score"], q.max, current_test["name"], current_test["output"])
-            continue
+        else:
+            program_path = os.path.abspath(program)
+            cases = get_test_cases(qid)
+            results = [None] * len(cases)
+            if q.batched_driver:
+                async with stages.run:
+                    loop = asyncio.get_event_loop()
+                    results = await loop.run_in_executor(None, run_batched_driver, cases, q.test_points,
+                                                         program_path, q.limits, q.comparator)
+            remaining = [idx for idx, result in enumerate(results) if result is None]
+            separate = await asyncio.gather(*[run_test_case_async(cases[idx], q.test_points, program_path, q.limits,
+                                                                  q.comparator, stages) for idx in remaining])
+            for idx, result in zip(remaining, separate):
+                results[idx] = result
+            record_test_results(current_test, results)
+
+            # Performance tests need wait4's CPU times, so they run through run_captured on a worker thread,
+            # once every other compile, test and comparison has stopped
+            if len(q.perf_tests) != 0:
+                await stages.acquire_all()
+                try:
+                    loop = asyncio.get_event_loop()
+                    await loop.run_in_executor(None, run_performance_tests, current_test, q, program_path)
+                finally:
+                    stages.release_all()
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    profiler.record("question", qid, time.monotonic() - start)
+    sys.stdout.flush()
+    current_test["output"] = str(current_test["output"])
+    return current_test
+
+# Grades questions pending (indices into checkpoint.questions) through the pipeline,
+# returning their current_test dictionaries in order, None for any skipped by the time budget
+async def grade_questions_async(checkpoint, pending):
+    import asyncio
+    questions = [checkpoint.questions[idx] for idx in pending]
+    stages = PipelineStages()
+    loop = asyncio.get_event_loop()
+
+    # Precompiled headers are looked up (on worker threads) before anything that could include them
+    pch_flags = [compile_flags] + ([check_only_flags] if check_only_compiles else [])
+    await asyncio.gather(*[loop.run_in_executor(None, get_pch_dir, flags) for flags in pch_flags])
+
+    build_dir = tempfile.mkdtemp(prefix='build-')
+    try:
+        paths = translation_units(questions)
+        print(f'Compiling {len(paths)} translation units: {" ".join(paths)}')
+        objects = {path: asyncio.ensure_future(compile_unit_async(path, build_dir, not optimised, stages))
+                   for path, optimised in paths.items()}
+        return await asyncio.gather(*[grade_pending_async(checkpoint, idx, objects, stages) for idx in pending])
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+# Every question starts at once in the pipeline, so the time budget is checked once its programs are built
+async def grade_pending_async(checkpoint, idx, objects, stages):
+    current_test = await grade_question_async(checkpoint.questions[idx], objects, stages,
+                                              lambda: checkpoint.out_of_time(idx))
+    if current_test is not None:
+        # Rewrites results.json, so it's done on a worker thread
+        await run_in_thread(checkpoint.record, idx, current_test)
+    return current_test
+
+# ===============================
+#     Question result cache
+# ===============================
+# Identifies the grading code, so changing this script invalidates every cached result
+@lru_cache(maxsize=None)
+def grader_version():
+    return cache_key(script_hash(), compiler_version())
+
+@lru_cache(maxsize=None)
+def script_hash():
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return cache_key(f.read())
+
+def hash_files(parts, dir_prefix, names):
+    for name in names:
+        parts.append(dir_prefix + name)
+        try:
+            with open(dir_prefix + name, 'rb') as f:
+                parts.append(f.read())
+        except OSError:
+            parts.append("<missing>")
 
-        # Run tests
-        run_tests(current_test, qid, q.test_points)
+def list_headers(directory):
+    try:
+        return sorted(name for name in os.listdir(directory) if is_header(name))
+    except OSError:
+        return []
+
+# Paths of every file in directory and its subdirectories, relative to it
+def list_files(directory):
+    names = []
+    for root, _, files in os.walk(directory):
+        rel_dir = os.path.relpath(root, directory)
+        names += [name if rel_dir == "." else os.path.join(rel_dir, name) for name in files]
+    return sorted(names)
+
+# Returns hash of every file in the submission. Any of them could be included by a submitted file
+# (.tpp, .inc, a .cpp, headers in subdirectories) or read by a test, so all of them are part of each
+# question's key.
+def submission_key():
+    parts = []
+    hash_files(parts, sub_prefix, list_files(sub_prefix))
+    return cache_key(*parts)
+
+# Everything that defines question q, as JSON-compatible values
+def question_definition(q):
+    return {
+        "qid": q.qid,
+        "max": q.max,
+        "f_points": q.f_points,
+        "test_points": q.test_points,
+        "tester_idx": q.tester_idx,
+        "extra_files": q.extra_files,
+        "compile_tests": [[t.submitted_files, t.provided_files, t.points] for t in q.compile_tests],
+        "limits": vars(default_limits.merge(q.limits)),
+        "batched_driver": q.batched_driver,
+        "comparator": vars(default_comparator.merge(q.comparator)),
+        "perf_tests": [vars(perf) for perf in q.perf_tests]
+    }
+
+# Returns hash of everything that can affect question q's result: the submission, its provided files,
+# every provided header that could be included, its test fixtures and the grading configuration.
+# submitted_hash is submission_key(), which is the same for every question of a submission.
+def question_key(q, submitted_hash = None):
+    config = {
+        "question": question_definition(q),
+        "feedback_limit": feedback_limit,
+        "compile_flags": compile_flags,
+        "check_only_flags": check_only_flags if check_only_compiles else None,
+        "output_limits": [output_limit, error_limit],
+        "diff_limits": [diff_max_lines, diff_max_compare_lines]
+    }
+    provided_hash = q.provided_hash if q.provided_hash is not None else provided_key(q)
+    if submitted_hash is None:
+        submitted_hash = submission_key()
+    return cache_key(grader_version(), json.dumps(config, sort_keys=True), provided_hash, submitted_hash)
+
+# Returns hash of question q's files in source/: provided files and headers, test fixtures and
+# performance test inputs. These are the same for every submission, so the grading plan records it.
+def provided_key(q):
+    parts = []
+    provided = {}
+    for compile_test in q.compile_tests:
+        provided.update(dict.fromkeys(compile_test.provided_files))
+    for perf in q.perf_tests:
+        provided.update(dict.fromkeys(perf.input_name(q.qid, size) for size in perf.sizes))
+    provided.update(dict.fromkeys(list_headers(src_prefix)))
+    hash_files(parts, src_prefix, sorted(provided))
+
+    for case in get_test_cases(q.qid):
+        for kind in fixture_kinds:
+            data = case.read(kind)
+            parts += [f'{case.tid}-{kind}', data if data is not None else "<missing>"]
+    return cache_key(*parts)
+
+# Returns previously recorded current_test for key, or None
+def load_cached_result(key):
+    if not result_cache or not compile_cache_enabled():
+        return None
+    path = cache_entry("results", key + ".json")
+    try:
+        with open(path) as f:
+            current_test = json.load(f)
+    except (OSError, ValueError):
+        return None
+    cache_lookup(path)
+    return current_test
+
+def store_cached_result(key, current_test):
+    if not result_cache or not compile_cache_enabled() or not current_test.get("cacheable", True):
+        return
+    try:
+        tmp_path = cache_tmp_path("results")
+        with open(tmp_path, 'w') as f:
+            json.dump(current_test, f)
+        cache_store(tmp_path, cache_entry("results", key + ".json"))
+    except OSError as ex:
+        print(f'Unable to cache result ({ex}).')
+
+def load_metadata(path):
+    meta_data = {}
+    try:
+        with open(path) as md:
+            meta_data = json.load(md)
+    except BaseException as ex:
+        print(f'An error occured when trying to open {path}')
+        print(str(ex))
+    return meta_data
+
+# meta_data is the submission's metadata, read from submission_metadata.json if not given
+# results_path, if given, is checkpointed with the results so far after each question (see ResultsCheckpoint)
+def run_questions(questions, participation_only = False, participation_grade = 1, meta_data = None,
+                  results_path = None):
+    global profiler
+    profiler = Profiler()
+    with profile_phase("run_questions", "all"):
+        result_json = grade_submission(questions, participation_only, participation_grade, meta_data, results_path)
 
-        record_test(result_json, current_test["score"], q.max, current_test["name"], current_test["output"])
+    # Profile is kept out of sight of students, in the extra_data section gradescope doesn't display
+    result_json['extra_data'] = {'profile': profiler.to_json()}
+    write_profile(result_json)
 
-        sys.stdout.flush()
+    return result_json
+
+def grade_submission(questions, participation_only = False, participation_grade = 1, meta_data = None,
+                     results_path = None):
+    if meta_data is None:
+        meta_data = load_metadata('submission_metadata.json')
+
+    # ===============================
+    #       Run Question tests
+    # ===============================
+    # Questions whose inputs haven't changed since they were last graded reuse that result
+    submitted_hash = submission_key()
+    keys = [question_key(q, submitted_hash) for q in questions]
+    current_tests = [load_cached_result(key) for key in keys]
+    for q, current_test in zip(questions, current_tests):
+        if current_test is not None:
+            print(f'Q{q.qid} is unchanged since it was last graded, reusing its result.')
+            profiler.record("cached_question", q.qid, 0.0)
+    pending = [idx for idx, current_test in enumerate(current_tests) if current_test is None]
+    checkpoint = ResultsCheckpoint(questions, current_tests, results_path, meta_data, participation_only,
+                                   participation_grade)
+    checkpoint.write()
+
+    # Questions are independent (each builds and tests inside its own workspace), so they're graded
+    # concurrently. Results are recorded in question order so result_json is deterministic.
+    # Shared translation units are compiled once up front, then each question links its own targets
+    if async_engine:
+        import asyncio
+        graded = asyncio.run(grade_questions_async(checkpoint, pending))
+    else:
+        build_dir = tempfile.mkdtemp(prefix='build-')
+        try:
+            objects = build_objects([questions[idx] for idx in pending], build_dir)
+            graded = run_pool(lambda idx: grade_pending(checkpoint, idx, objects), pending, question_workers)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    for idx, current_test in zip(pending, graded):
+        if current_test is not None:
+            store_cached_result(keys[idx], current_test)
+            current_tests[idx] = current_test
+
+    sys.stdout.flush()
+    return finish_results(questions, current_tests, meta_data, participation_only, participation_grade,
+                          checkpoint.skipped)
+
+# Builds result_json from the current_test of each question, None for questions that weren't graded,
+# then applies the cap, late penalty and previous submissions to the total of whatever was graded.
+# skipped holds indices of questions skipped because the time budget ran out.
+# quiet leaves out the late penalty and previous submission log lines, for checkpoints written before the end.
+def finish_results(questions, current_tests, meta_data, participation_only = False, participation_grade = 1,
+                   skipped = (), quiet = False):
+    result_json = {'score': 0, 'visibility': 'visible', 'stdout_visibility': 'hidden', 'tests': []}
+
+    for idx, (q, current_test) in enumerate(zip(questions, current_tests)):
+        if current_test is not None:
+            record_test(result_json, current_test["score"], q.max, current_test["name"], current_test["output"])
+        elif idx in skipped:
+            record_test(result_json, 0, q.max, f'Q{q.qid}',
+                        f'Q{q.qid} was not graded: the grading time limit of {time_budget} seconds ran out.\n')
+        else:
+            record_test(result_json, 0, q.max, f'Q{q.qid}', f'Q{q.qid} has not been graded yet.\n')
 
     # ===============================
     #      Capping/Late Penalties
@@ -549,9 +2687,9 @@ def run_questions(questions, participation_only = False, participation_grade = 1
 
     total_score = apply_cap(meta_test, meta_data, total_score, participation_only, participation_grade)
 
-    total_score = apply_late_penalty(meta_test, meta_data, total_score)
+    total_score = apply_late_penalty(meta_test, meta_data, total_score, quiet)
 
-    total_score = check_previous(meta_test, meta_data, total_score)
+    total_score = check_previous(meta_test, meta_data, total_score, quiet)
 
     result_json['tests'].append(meta_test)
     result_json['score'] = total_score
@@ -559,5 +2697,666 @@ def run_questions(questions, participation_only = False, participation_grade = 1
     return result_json
 
 
+# ===============================
+#   Checkpoints and time budget
+# ===============================
+# Deadline (time.monotonic()) of the submission being graded, None without a time budget. Tests and
+# performance trials check it before they start, so a question already running stops early too.
+_grading_deadline = None
+
+# Starts the time budget of a new submission, returning its deadline
+def start_time_budget():
+    global _grading_deadline
+    _grading_deadline = None if time_budget is None else time.monotonic() + time_budget
+    return _grading_deadline
+
+def budget_exhausted():
+    return _grading_deadline is not None and time.monotonic() >= _grading_deadline
+
+# Collects question results as they finish. If results_path is set, results.json is rewritten after every
+# question with the cap and penalties applied to the questions graded so far, so the student still gets
+# marks for those if the platform kills the run at its global timeout.
+class ResultsCheckpoint:
+    def __init__(self, questions, current_tests, results_path = None, meta_data = None, participation_only = False,
+                 participation_grade = 1):
+        self.questions = questions
+        self.current_tests = current_tests          # Shared with grade_submission, None until graded
+        self.results_path = results_path
+        self.meta_data = meta_data
+        self.participation_only = participation_only
+        self.participation_grade = participation_grade
+        self.skipped = set()
+        self.lock = threading.Lock()
+        start_time_budget()
+
+    # Returns True, and marks question idx as skipped in the checkpoint, if the time budget has run out
+    def out_of_time(self, idx):
+        if not budget_exhausted():
+            return False
+        print(f'Grading time limit of {time_budget} seconds reached, skipping Q{self.questions[idx].qid}.')
+        with self.lock:
+            self.skipped.add(idx)
+            self.write_locked()
+        return True
+
+    def record(self, idx, current_test):
+        with self.lock:
+            self.current_tests[idx] = current_test
+            self.write_locked()
+
+    def write(self):
+        with self.lock:
+            self.write_locked()
+
+    def write_locked(self):
+        if self.results_path is None:
+            return
+        result_json = finish_results(self.questions, self.current_tests, self.meta_data, self.participation_only,
+                                     self.participation_grade, self.skipped, quiet=True)
+        try:
+            write_results(result_json, self.results_path)
+        except OSError as ex:
+            print(f'Unable to checkpoint results to {self.results_path} ({ex}).')
+
+# Grades question idx, checkpointing its result. Once the time budget has run out, a question is only
+# graded if some of its files were compiled in time, so it keeps the compile marks it has already earned
+# (its tests are then skipped one by one, see budget_outcome).
+def grade_pending(checkpoint, idx, objects):
+    if not question_compiled(checkpoint.questions[idx], objects) and checkpoint.out_of_time(idx):
+        return None
+    current_test = grade_question(checkpoint.questions[idx], objects)
+    checkpoint.record(idx, current_test)
+    return current_test
+
+
+# ===============================
+#         Grading plan
+# ===============================
+# The grading plan records everything about the questions that doesn't depend on the submission: each
+# question's required files, its tests, a hash of its files in source/ and its total points. It's saved to
+# plan_file and reused until the questions, source/ or this script change. Each run still lists source/ and
+# stats its files to check that, but doesn't read, classify or hash them before it starts grading.
+# build_plan also checks the questions for likely mistakes.
+plan_file = "grading_plan.json"
+
+# Name, size and modification time of every file in source/, to tell whether a plan is out of date.
+# Files edited in place don't change the directory's own mtime, so every file is checked.
+def source_snapshot(src_dir = src_prefix):
+    snapshot = {}
+    with os.scandir(src_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                snapshot[entry.name] = [stat.st_size, stat.st_mtime_ns]
+    return snapshot
+
+def definitions_key(questions):
+    return cache_key(json.dumps([question_definition(q) for q in questions], sort_keys=True))
+
+# Points available from q's files, compiles, functionality tests and performance tests
+def points_total(q):
+    total = q.f_points + sum(compile_test.points for compile_test in q.compile_tests)
+    total += q.test_points * len(get_test_cases(q.qid))
+    for perf in q.perf_tests:
+        if perf.max_cpu_time is not None:
+            total += perf.time_points
+        if perf.complexity is not None:
+            total += perf.complexity_points
+    return total
+
+# Returns list of likely mistakes in the question definitions
+def check_questions(questions):
+    problems = []
+    seen = set()
+    for q in questions:
+        if q.qid in seen:
+            problems.append(f'Q{q.qid}: question id is used more than once.')
+        seen.add(q.qid)
+        for compile_test in q.compile_tests:
+            for name in compile_test.provided_files:
+                if not os.path.isfile(src_prefix + name):
+                    problems.append(f'Q{q.qid}: provided file {src_prefix}{name} does not exist.')
+        if len(q.compile_tests) == 0 and (len(get_test_cases(q.qid)) != 0 or len(q.perf_tests) != 0):
+            problems.append(f'Q{q.qid}: has tests but no CompileTest to build the test driver, they will never run.')
+        total = points_total(q)
+        if total != q.max:
+            problems.append(f'Q{q.qid}: max_points is {q.max} but its tests are worth {total} points.')
+    return problems
+
+# Builds the grading plan for questions and saves it to path (plan_file by default). Returns the plan.
+def build_plan(questions, path = None):
+    if path is None:
+        path = plan_file
+    manifest = get_manifest()
+    plan = {
+        "script": script_hash(),
+        "definitions": definitions_key(questions),
+        "source": source_snapshot(),
+        "problems": check_questions(questions),
+        "manifest": {qid: [[case.tid, {kind: os.path.basename(name) for kind, name in case.files.items()}]
+                           for case in cases] for qid, cases in manifest.items()},
+        "questions": [{
+            "qid": q.qid,
+            "required_files": q.get_required_files(),
+            "provided_hash": provided_key(q),
+            "points_total": points_total(q)
+        } for q in questions]
+    }
+    for problem in plan["problems"]:
+        print(f'Grading plan: {problem}')
+
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(plan, f)
+        os.replace(tmp_path, path)
+    except OSError as ex:
+        print(f'Unable to save grading plan to {path} ({ex}).')
+    return plan
+
+# Uses the saved grading plan for questions, rebuilding it first if it's missing or out of date.
+# Returns questions.
+def load_plan(questions, path = None):
+    if path is None:
+        path = plan_file
+    try:
+        with open(path) as f:
+            plan = json.load(f)
+    except (OSError, ValueError):
+        plan = None
+
+    if (plan is None or plan.get("script") != script_hash() or plan.get("definitions") != definitions_key(questions)
+            or plan.get("source") != source_snapshot()):
+        print(f'Grading plan {path} is missing or out of date, rebuilding it.')
+        plan = build_plan(questions, path)
+    apply_plan(questions, plan)
+    return questions
+
+def apply_plan(questions, plan):
+    for q, planned in zip(questions, plan["questions"]):
+        q.required_files = planned["required_files"]
+        q.provided_hash = planned["provided_hash"]
+
+    # The plan's tests replace scanning source/, fixtures are read when a test needs them
+    manifest = {}
+    for qid, tests in plan["manifest"].items():
+        cases = []
+        for tid, files in tests:
+            case = TestCase(qid, tid)
+            case.files = {kind: os.path.join(src_prefix, name) for kind, name in files.items()}
+            cases.append(case)
+        manifest[qid] = cases
+    key = (os.path.abspath(src_prefix), os.stat(src_prefix).st_mtime_ns)
+    with _manifest_lock:
+        _manifests[key] = manifest
+
+
+# ===============================
+#         Batch grading
+# ===============================
+# Grades a whole directory of submissions in one process pool, e.g. to regrade a cohort after fixing a test.
+# Each sub-directory of submissions_dir holds one submission's files. Metadata comes from metadata_file,
+# a JSONL file with one {"id": <sub-directory name>, "metadata": {...}} object per submission, or failing
+# that from submission_metadata.json inside each submission's directory.
+# Workers share the fixture manifest, precompiled headers and compile cache, so provided test drivers are
+# only compiled once. One {"id", "score", "wall_time", "result"} JSON line is written to output_file as each
+# submission finishes, and the log of each submission is written to log_dir if given.
+# A worker process that dies (e.g. killed for running out of memory) takes its pool down with it. The
+# submissions that were being graded are graded again one at a time, each in its own pool, the rest in a
+# new shared pool. A submission whose own worker dies batch_max_attempts times is recorded with an "error"
+# instead of a result.
+
+_batch_config = {}
+batch_max_attempts = 2
+
+# Points grading at another submission directory
+def use_submission(path):
+    global sub_prefix, include_dirs
+    sub_prefix = os.path.join(path, '')
+    include_dirs = [sub_prefix, src_prefix]
+
+def get_batch_jobs(submissions_dir, metadata_file = None):
+    jobs = []
+    if metadata_file is not None:
+        with open(metadata_file) as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                entry = json.loads(line)
+                sub_id = str(entry["id"])
+                jobs.append((sub_id, os.path.join(submissions_dir, sub_id), entry.get("metadata")))
+    else:
+        for name in sorted(os.listdir(submissions_dir)):
+            if os.path.isdir(os.path.join(submissions_dir, name)):
+                jobs.append((name, os.path.join(submissions_dir, name), None))
+    return jobs
+
+def init_batch_worker(config):
+    global question_workers, test_workers, compile_workers
+    _batch_config.update(config)
+    # Submissions are the unit of parallelism, so each worker grades its submission serially
+    question_workers = test_workers = compile_workers = 1
+
+# Log file name of a submission, which can't step outside log_dir whatever its id
+def batch_log_name(sub_id):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', sub_id).lstrip('.') + ".log"
+
+# started_path, if given, is created when grading starts, so run_batch can tell which submissions were
+# being graded when a worker died
+def grade_batch_job(job, started_path = None):
+    sub_id, sub_dir, meta_data = job
+    config = _batch_config
+    start = time.monotonic()
+    record = {"id": sub_id}
+    if started_path is not None:
+        with open(started_path, 'w'):
+            pass
+    if meta_data is None:
+        meta_data = load_metadata(os.path.join(sub_dir, 'submission_metadata.json'))
+
+    log_dir = config.get("log_dir")
+    log = open(os.path.join(log_dir, batch_log_name(sub_id)), 'w') if log_dir else open(os.devnull, 'w')
+    try:
+        with log, redirect_stdout(log):
+            use_submission(sub_dir)
+            result_json = run_questions(config["questions"], config["participation_only"],
+                                        config["participation_grade"], meta_data)
+        record["score"] = result_json["score"]
+        record["result"] = result_json
+    except Exception as ex:
+        record["score"] = None
+        record["error"] = f'{type(ex).__name__}: {ex}'
+    record["wall_time"] = round(time.monotonic() - start, 3)
+    return record
+
+def print_batch_progress(record, done, total, start):
+    elapsed = time.monotonic() - start
+    rate = done / elapsed * 60 if elapsed > 0 else 0.0
+    remaining = (total - done) / (done / elapsed) if done > 0 and elapsed > 0 else 0.0
+    status = record.get("error", f'score {record["score"]}')
+    if record["wall_time"] is not None:
+        status += f' in {record["wall_time"]}s'
+    print(f'[{done}/{total}] {record["id"]}: {status} '
+          f'({rate:.1f} submissions/min, ~{remaining:.0f}s remaining)')
+    sys.stdout.flush()
+
+# Grades jobs[idx] for each idx in indices in a new pool of workers processes, calling report(idx, record) as
+# each submission finishes. Returns (indices lost when a worker died, the subset of those that had started).
+def grade_batch_pool(jobs, indices, workers, config, report):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from concurrent.futures.process import BrokenProcessPool
+
+    broken = []
+    started_dir = tempfile.mkdtemp(prefix='batch-started-')
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=init_batch_worker, initargs=(config,)) as pool:
+            futures = {pool.submit(grade_batch_job, jobs[idx], os.path.join(started_dir, str(idx))): idx
+                       for idx in indices}
+            for future in as_completed(futures):
+                idx = futures[future]
+                try:
+                    record = future.result()
+                except BrokenProcessPool:
+                    broken.append(idx)
+                    continue
+                except Exception as ex:
+                    record = {"id": jobs[idx][0], "score": None, "wall_time": None,
+                              "error": f'{type(ex).__name__}: {ex}'}
+                report(idx, record)
+        started = [idx for idx in broken if os.path.exists(os.path.join(started_dir, str(idx)))]
+    finally:
+        shutil.rmtree(started_dir, ignore_errors=True)
+    return broken, started
+
+# Grades jobs[idx] in a pool of its own, so a worker that dies can only have been killed by this submission
+def grade_batch_alone(jobs, idx, config, report):
+    for attempt in range(1, batch_max_attempts + 1):
+        broken, _ = grade_batch_pool(jobs, [idx], 1, config, report)
+        if len(broken) == 0:
+            return
+        print(f'Submission {jobs[idx][0]} killed its worker process (attempt {attempt} of {batch_max_attempts}).')
+    report(idx, {"id": jobs[idx][0], "score": None, "wall_time": None,
+                 "error": f'worker process died while grading it {batch_max_attempts} times'})
+
+def run_batch(questions, submissions_dir, output_file, metadata_file = None, workers = 0,
+              participation_only = False, participation_grade = 1, log_dir = None):
+    jobs = get_batch_jobs(submissions_dir, metadata_file)
+    if workers <= 0:
+        workers = available_cores()
+    workers = max(1, min(workers, len(jobs)))
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    # Discover fixtures and precompile headers once, workers inherit them when forked
+    get_manifest()
+    build_precompiled_headers()
+
+    config = {
+        "questions": questions,
+        "participation_only": participation_only,
+        "participation_grade": participation_grade,
+        "log_dir": log_dir
+    }
+    print(f'Grading {len(jobs)} submissions from {submissions_dir} with {workers} workers...')
+    start = time.monotonic()
+    with open(output_file, 'w') as out:
+        done = 0
+
+        # Written as each submission finishes, so a long batch can be watched
+        def report(idx, record):
+            nonlocal done
+            done += 1
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            print_batch_progress(record, done, len(jobs), start)
+
+        pending = list(range(len(jobs)))
+        while len(pending) != 0:
+            broken, started = grade_batch_pool(jobs, pending, workers, config, report)
+            if len(broken) == 0:
+                break
+            # Any submission being graded when a worker died could have killed it, so those are graded again
+            # one at a time and only the culprit is charged an attempt. Ones that hadn't started go back in the
+            # pool. If none had started, the pool itself failed and every submission is graded alone.
+            suspects = started if len(started) != 0 else broken
+            pending = [idx for idx in broken if idx not in suspects]
+            print(f'A worker process died, grading {len(suspects)} submissions it may have been grading one at a '
+                  f'time and {len(pending)} unfinished submissions again.')
+            for idx in suspects:
+                grade_batch_alone(jobs, idx, config, report)
+
+    elapsed = time.monotonic() - start
+    rate = len(jobs) / elapsed * 60 if elapsed > 0 else 0.0
+    print(f'Graded {len(jobs)} submissions in {elapsed:.1f}s ({rate:.1f} submissions/min). Results in {output_file}')
+
+
+# ===============================
+#    Distributed grading spool
+# ===============================
+# Spreads a batch of submissions over worker processes on any number of hosts. A coordinator
+# (run_coordinator) queues each submission as a job in a spool directory, and workers (run_worker) claim
+# jobs, grade them with run_questions and write back their result records. The spool only relies on
+# atomic renames within one filesystem, so it works on a single machine or on a shared filesystem
+# mounted at the same path on every host (submission directories must be too). Spool layout:
+#   queue/                  jobs waiting for a worker, at most queue_limit at a time (backpressure)
+#   claimed/<worker>/       jobs being graded, moved here from queue/ by the worker that claimed them
+#   results/                result records waiting for the coordinator
+#   heartbeats/<worker>     touched by each worker every spool_heartbeat_interval seconds
+#   tmp/                    files being written, renamed into place once complete
+#   stop                    created by the coordinator once every job has a result
+# Jobs claimed by a worker whose heartbeat is older than spool_worker_timeout seconds (hosts' clocks must
+# roughly agree) are requeued, up to spool_max_attempts times in total. Workers write their first heartbeat
+# before creating their claimed directory, and a claimed directory without a heartbeat is only taken for
+# dead once it's also older than spool_worker_timeout. Submissions are identified by id:
+# each id is queued once, only its first result is kept, and ids already in output_file aren't regraded.
+
+spool_poll_interval = 0.2
+spool_heartbeat_interval = 2.0
+spool_worker_timeout = 30.0
+spool_max_attempts = 3
+spool_queue_limit = 32
+
+def spool_path(spool_dir, *parts):
+    return os.path.join(spool_dir, *parts)
+
+def init_spool(spool_dir):
+    for name in ["queue", "claimed", "results", "heartbeats", "tmp"]:
+        os.makedirs(spool_path(spool_dir, name), exist_ok=True)
+
+# Job and result files are named by a hash of the submission id, which may not be a valid file name
+def spool_file_name(sub_id):
+    return cache_key(sub_id) + ".json"
+
+# Writes data as JSON to spool_dir/kind/name, so it never appears partially written
+def write_spool_file(spool_dir, kind, name, data):
+    fd, tmp_path = tempfile.mkstemp(dir=spool_path(spool_dir, "tmp"), suffix=".tmp")
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, spool_path(spool_dir, kind, name))
+
+def read_spool_file(path):
+    with open(path) as f:
+        return json.load(f)
+
+def list_spool(spool_dir, *parts):
+    try:
+        return sorted(os.listdir(spool_path(spool_dir, *parts)))
+    except OSError:
+        return []
+
+# Returns ids of the submissions already recorded in output_file
+def recorded_ids(output_file):
+    ids = set()
+    try:
+        with open(output_file) as f:
+            for line in f:
+                try:
+                    ids.add(json.loads(line)["id"])
+                except (ValueError, KeyError):
+                    continue
+    except OSError:
+        pass
+    return ids
+
+def worker_alive(spool_dir, worker_id):
+    now = time.time()
+    try:
+        return now - os.stat(spool_path(spool_dir, "heartbeats", worker_id)).st_mtime < spool_worker_timeout
+    except OSError:
+        pass
+    # No heartbeat, e.g. a worker that's exiting: its claimed directory changes whenever it claims or
+    # finishes a job, so a recently changed one still belongs to a live worker
+    try:
+        return now - os.stat(spool_path(spool_dir, "claimed", worker_id)).st_mtime < spool_worker_timeout
+    except OSError:
+        return False
+
+# Moves jobs claimed by dead workers back to the queue. Jobs that have used up their attempts are
+# returned as failed result records instead.
+def requeue_dead_workers(spool_dir):
+    failed = []
+    for worker_id in list_spool(spool_dir, "claimed"):
+        if worker_alive(spool_dir, worker_id):
+            continue
+        for name in list_spool(spool_dir, "claimed", worker_id):
+            path = spool_path(spool_dir, "claimed", worker_id, name)
+            try:
+                job = read_spool_file(path)
+            except (OSError, ValueError):
+                continue
+            job["attempts"] += 1
+            if job["attempts"] >= spool_max_attempts:
+                print(f'Submission {job["id"]} was being graded by {worker_id}, which stopped responding. '
+                      f'Giving up after {job["attempts"]} attempts.')
+                failed.append({"id": job["id"], "score": None, "wall_time": None,
+                               "error": f'grading failed {job["attempts"]} times (worker stopped responding)'})
+            else:
+                print(f'Submission {job["id"]} was being graded by {worker_id}, which stopped responding. Requeuing.')
+                write_spool_file(spool_dir, "queue", name, job)
+            silent_remove(path)
+        try:
+            os.rmdir(spool_path(spool_dir, "claimed", worker_id))
+        except OSError:
+            pass
+        silent_remove(spool_path(spool_dir, "heartbeats", worker_id))
+    return failed
+
+def run_coordinator(questions, submissions_dir, output_file, spool_dir, metadata_file = None, local_workers = 0,
+                    queue_limit = None, participation_only = False, participation_grade = 1, log_dir = None):
+    import multiprocessing
+
+    if queue_limit is None:
+        queue_limit = spool_queue_limit
+    init_spool(spool_dir)
+    silent_remove(spool_path(spool_dir, "stop"))
+
+    # A submission listed more than once is graded once, using its last entry
+    jobs = {}
+    for sub_id, sub_dir, meta_data in get_batch_jobs(submissions_dir, metadata_file):
+        jobs[sub_id] = {"id": sub_id, "dir": os.path.abspath(sub_dir), "metadata": meta_data, "attempts": 0}
+    finished = recorded_ids(output_file)
+    outstanding = set(jobs) - finished
+
+    # Jobs left in the spool by an earlier coordinator are still being graded
+    spooled = set(list_spool(spool_dir, "queue"))
+    for worker_id in list_spool(spool_dir, "claimed"):
+        spooled.update(list_spool(spool_dir, "claimed", worker_id))
+    to_queue = [jobs[sub_id] for sub_id in jobs if sub_id in outstanding and spool_file_name(sub_id) not in spooled]
+
+    print(f'Coordinating {len(outstanding)} submissions from {submissions_dir} through {spool_dir} '
+          f'({len(jobs) - len(outstanding)} already graded).')
+
+    workers = []
+    if local_workers > 0:
+        get_manifest()
+        build_precompiled_headers()
+        context = multiprocessing.get_context("fork")
+        for _ in range(local_workers):
+            worker = context.Process(target=run_worker, args=(questions, spool_dir, participation_only,
+                                                              participation_grade, log_dir))
+            worker.start()
+            workers.append(worker)
+
+    start = time.monotonic()
+    total = len(outstanding)
+    try:
+        with open(output_file, 'a') as out:
+            while len(outstanding) != 0:
+                records = []
+                for name in list_spool(spool_dir, "results"):
+                    path = spool_path(spool_dir, "results", name)
+                    try:
+                        records.append(read_spool_file(path))
+                    except (OSError, ValueError):
+                        continue
+                    silent_remove(path)
+                records += requeue_dead_workers(spool_dir)
+
+                for record in records:
+                    if record["id"] not in outstanding:
+                        continue
+                    outstanding.discard(record["id"])
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                    done = total - len(outstanding)
+                    elapsed = time.monotonic() - start
+                    rate = done / elapsed * 60 if elapsed > 0 else 0.0
+                    status = record.get("error", f'score {record["score"]}')
+                    print(f'[{done}/{total}] {record["id"]}: {status} ({rate:.1f} submissions/min)')
+                    sys.stdout.flush()
+
+                # Only keep queue_limit jobs waiting, so workers that join late still get an even share
+                queued = len(list_spool(spool_dir, "queue"))
+                while len(to_queue) != 0 and queued < queue_limit:
+                    job = to_queue.pop(0)
+                    write_spool_file(spool_dir, "queue", spool_file_name(job["id"]), job)
+                    queued += 1
+
+                if len(outstanding) != 0:
+                    time.sleep(spool_poll_interval)
+    finally:
+        with open(spool_path(spool_dir, "stop"), 'w'):
+            pass
+        for worker in workers:
+            worker.join()
+
+    elapsed = time.monotonic() - start
+    rate = total / elapsed * 60 if elapsed > 0 else 0.0
+    print(f'Graded {total} submissions in {elapsed:.1f}s ({rate:.1f} submissions/min). Results in {output_file}')
+
+# True if the coordinator created the spool's stop file after since (a time.time() timestamp)
+def spool_stopped(spool_dir, since):
+    try:
+        return os.stat(spool_path(spool_dir, "stop")).st_mtime >= since
+    except OSError:
+        return False
+
+def touch_heartbeat(path):
+    try:
+        with open(path, 'a'):
+            os.utime(path)
+    except OSError:
+        pass
+
+# Touches the worker's heartbeat file until stopped is set
+def heartbeat(path, stopped):
+    while not stopped.wait(spool_heartbeat_interval):
+        touch_heartbeat(path)
+
+# Claims the next queued job for worker_id, returning the path of the claimed job file or None
+def claim_job(spool_dir, worker_id):
+    claim_dir = spool_path(spool_dir, "claimed", worker_id)
+    for name in list_spool(spool_dir, "queue"):
+        queued = spool_path(spool_dir, "queue", name)
+        claimed = os.path.join(claim_dir, name)
+        for attempt in range(2):
+            try:
+                os.rename(queued, claimed)
+                return claimed
+            except FileNotFoundError:
+                if not os.path.exists(queued):
+                    # Another worker claimed it first
+                    break
+                # The coordinator took this worker for dead (e.g. it was paused) and removed its claimed directory
+                print(f'Worker {worker_id} was taken for dead by the coordinator, rejoining.')
+                os.makedirs(claim_dir, exist_ok=True)
+    return None
+
+# Grades jobs from spool_dir until the coordinator has every result. Start one worker per core,
+# each grades one submission at a time. A stop file older than the worker is left from an earlier run
+# and ignored, so workers can be started before the coordinator.
+def run_worker(questions, spool_dir, participation_only = False, participation_grade = 1, log_dir = None,
+               worker_id = None):
+    import socket
+
+    if worker_id is None:
+        worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    init_spool(spool_dir)
+    # The heartbeat exists before any job can be claimed, so the coordinator never sees a claim without one
+    heartbeat_path = spool_path(spool_dir, "heartbeats", worker_id)
+    touch_heartbeat(heartbeat_path)
+    os.makedirs(spool_path(spool_dir, "claimed", worker_id), exist_ok=True)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    init_batch_worker({
+        "questions": questions,
+        "participation_only": participation_only,
+        "participation_grade": participation_grade,
+        "log_dir": log_dir
+    })
+
+    started = time.time()
+    stopped = threading.Event()
+    beat = threading.Thread(target=heartbeat, args=(heartbeat_path, stopped), daemon=True)
+    beat.start()
+    print(f'Worker {worker_id} grading jobs from {spool_dir}.')
+    graded = 0
+    try:
+        while True:
+            path = claim_job(spool_dir, worker_id)
+            if path is None:
+                if spool_stopped(spool_dir, started):
+                    break
+                time.sleep(spool_poll_interval)
+                continue
+            job = read_spool_file(path)
+            record = grade_batch_job((job["id"], job["dir"], job["metadata"]))
+            record["worker"] = worker_id
+            write_spool_file(spool_dir, "results", os.path.basename(path), record)
+            silent_remove(path)
+            graded += 1
+    finally:
+        stopped.set()
+        beat.join()
+        try:
+            os.rmdir(spool_path(spool_dir, "claimed", worker_id))
+        except OSError:
+            pass
+        silent_remove(heartbeat_path)
+    print(f'Worker {worker_id} stopping after grading {graded} submissions.')
+
+
 if __name__ == "__main__":
     print("Incorrectly running utility function as main driver. Run run_autograder instead.")
\ No newline at end of file
@@ -0,0 +1,370 @@
+#!/usr/bin/python3
+
+# =================================================================
+#                   Grading throughput benchmark
+# =================================================================
+# Generates a synthetic assignment (questions, test drivers, expected outputs) and a set of submissions
+# that pass, fail, crash, time out or flood stdout, grades each submission end to end with run_questions,
+# and writes throughput, per-submission latency and per-phase totals to a JSON report. Keep the report of
+# one version and pass it to --compare when benchmarking the next one.
+#
+#   ./benchmark.py --questions 4 --tests 8 --output-bytes 4096 --submissions 20
+#   ./benchmark.py --output results/after.json --compare results/before.json
+#
+# Every run starts from an empty compile/result cache in the benchmark's work directory, and every generated
+# submission is different, so the numbers don't depend on what was graded before.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import autograder_util as ag
+
+submission_kinds = ["pass", "fail", "crash", "timeout", "bomb"]
+default_mix = "pass=4,fail=2,crash=1,timeout=1,bomb=1"
+
+# Test driver for question qid: prints solve(test, lines) for the test number and line count in its args
+# file, which the grader passes as a single argument
+driver_source = """#include <iostream>
+#include <sstream>
+#include <string>
+
+std::string solve(int test, long long lines);
+
+int main(int argc, char* argv[]) {
+    int test = 0;
+    long long lines = 0;
+    if (argc < 2 || !(std::istringstream(argv[1]) >> test >> lines)) {
+        std::cout << "usage: " << argv[0] << " \\"test lines\\"" << std::endl;
+        return 1;
+    }
+    std::cout << solve(test, lines);
+    return 0;
+}
+"""
+
+main_source = """#include <iostream>
+#include <string>
+
+std::string solve(int test, long long lines);
+
+int main() {
+    std::cout << solve(0, 2) << "submission {sub}" << std::endl;
+    return 0;
+}
+"""
+
+# Body of solve() for each kind of submission. Every kind starts like the correct solution, so failing
+# output still has to be compared, and crashing or looping programs have written some output first.
+function_source = """#include <iostream>
+#include <string>
+
+int submission_id = {sub};
+
+std::string line(int test, long long i) {{
+    return std::to_string(test) + " " + std::to_string(i) + " " +
+           std::to_string((test * 7919LL + i * 104729LL) % 1000003LL) + "\\n";
+}}
+
+std::string solve(int test, long long lines) {{
+    std::string out;
+{body}
+    return out;
+}}
+"""
+
+function_bodies = {
+    "pass": """    for (long long i = 0; i < lines; i++) out += line(test, i);""",
+    # Last line of every test is wrong
+    "fail": """    for (long long i = 0; i + 1 < lines; i++) out += line(test, i);
+    out += line(test, lines);""",
+    "crash": """    for (long long i = 0; i < lines / 2; i++) out += line(test, i);
+    std::cout << out << std::flush;
+    volatile int* p = nullptr;
+    *p = test;""",
+    "timeout": """    for (long long i = 0; i < lines / 2; i++) out += line(test, i);
+    std::cout << out << std::flush;
+    volatile long long spin = 0;
+    while (true) spin++;""",
+    "bomb": """    for (long long i = 0; ; i++) std::cout << line(test, i);""",
+}
+
+def expected_line(test, i):
+    return f'{test} {i} {(test * 7919 + i * 104729) % 1000003}\n'
+
+# Number of lines whose output is at least output_bytes long (at least one line)
+def lines_for(test, output_bytes):
+    lines = 0
+    size = 0
+    while size < output_bytes or lines == 0:
+        size += len(expected_line(test, lines))
+        lines += 1
+    return lines
+
+def question_ids(num_questions):
+    return [f'1-{i}' for i in range(1, num_questions + 1)]
+
+# Parses "pass=4,fail=2" into a list of (kind, weight)
+def parse_mix(text):
+    mix = []
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in submission_kinds:
+            raise ValueError(f'unknown submission kind "{kind}" (expected one of {", ".join(submission_kinds)})')
+        mix.append((kind, int(weight) if weight else 1))
+    return mix
+
+# Kinds of num_submissions submissions, spread over the mix in proportion to its weights
+def submission_plan(mix, num_submissions):
+    cycle = [kind for kind, weight in mix for _ in range(weight)]
+    return [cycle[i % len(cycle)] for i in range(num_submissions)]
+
+def write_file(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+# Writes source/ for the assignment and one directory per submission under submissions/.
+# Returns a list of (submission id, kind).
+def generate_assignment(work_dir, num_questions, num_tests, output_bytes, kinds):
+    src_dir = os.path.join(work_dir, "source")
+    os.makedirs(src_dir)
+    for qid in question_ids(num_questions):
+        write_file(os.path.join(src_dir, f'test-{qid}.cpp'), driver_source)
+        for test in range(num_tests):
+            lines = lines_for(test, output_bytes)
+            write_file(os.path.join(src_dir, f'args-{qid}-{test:02d}'), f'{test} {lines}\n')
+            write_file(os.path.join(src_dir, f'output-{qid}-{test:02d}'),
+                       "".join(expected_line(test, i) for i in range(lines)))
+
+    submissions = []
+    for idx, kind in enumerate(kinds):
+        sub_id = f'{idx:04d}-{kind}'
+        sub_dir = os.path.join(work_dir, "submissions", sub_id)
+        os.makedirs(sub_dir)
+        for qid in question_ids(num_questions):
+            write_file(os.path.join(sub_dir, f'main-{qid}.cpp'), main_source.replace("{sub}", str(idx)))
+            write_file(os.path.join(sub_dir, f'function-{qid}.cpp'),
+                       function_source.format(sub=idx, body=function_bodies[kind]))
+        submissions.append((sub_id, kind))
+    return submissions
+
+def make_questions(num_questions, num_tests, timeout):
+    questions = []
+    for qid in question_ids(num_questions):
+        c_tests = [ag.CompileTest(points=1, provided_files=[], submitted_files=[f'function-{qid}.cpp', f'main-{qid}.cpp']),
+                   ag.CompileTest(points=1, provided_files=[f'test-{qid}.cpp'], submitted_files=[f'function-{qid}.cpp'])]
+        questions.append(ag.Question(qid, max_points=3 + num_tests, file_points=1, test_points=1, compile_tests=c_tests,
+                                     tester_idx=1, limits=ag.Limits(cpu_time=timeout, wall_time=timeout * 3)))
+    return questions
+
+# Metadata of an on-time submission with no previous submissions
+def make_metadata(total_points):
+    assignment = {"due_date": "2030-01-01T00:00:00.000000+00:00", "total_points": str(total_points)}
+    return {
+        "created_at": "2029-12-31T00:00:00.000000+00:00",
+        "assignment": assignment,
+        "users": [{"name": "Benchmark", "assignment": assignment}],
+        "previous_submissions": []
+    }
+
+# Nearest-rank percentile of a sorted list
+def percentile(values, pct):
+    if len(values) == 0:
+        return None
+    rank = max(1, -(-len(values) * pct // 100))
+    return round(values[int(rank) - 1], 4)
+
+def latency_summary(times):
+    times = sorted(times)
+    return {
+        "mean": round(sum(times) / len(times), 4) if times else None,
+        "p50": percentile(times, 50),
+        "p95": percentile(times, 95),
+        "max": round(times[-1], 4) if times else None
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+# Grades every submission in turn and returns the report. Must be run from work_dir, since the grader
+# finds source/ relative to the working directory.
+def run_benchmark(questions, submissions, work_dir, config, log):
+    meta_data = make_metadata(sum(q.max for q in questions))
+
+    # Precompiled headers and the test manifest are built once per assignment, not per submission
+    start = time.monotonic()
+    with redirect_stdout(log):
+        ag.get_manifest()
+        ag.build_precompiled_headers()
+    setup_time = time.monotonic() - start
+
+    results = []
+    phases = {}
+    start = time.monotonic()
+    for idx, (sub_id, kind) in enumerate(submissions):
+        ag.use_submission(os.path.join(work_dir, "submissions", sub_id))
+        sub_start = time.monotonic()
+        with redirect_stdout(log):
+            result_json = ag.run_questions(questions, meta_data=meta_data)
+        wall_time = time.monotonic() - sub_start
+        results.append({"id": sub_id, "kind": kind, "wall_time": round(wall_time, 4), "score": result_json["score"]})
+        print(f'[{idx + 1}/{len(submissions)}] {sub_id}: score {result_json["score"]} in {wall_time:.2f}s')
+
+        for phase, total in result_json["extra_data"]["profile"]["summary"].items():
+            phase_total = phases.setdefault(phase, {"count": 0, "wall_time": 0.0, "user_time": 0.0, "sys_time": 0.0})
+            for field in ["count", "wall_time", "user_time", "sys_time"]:
+                phase_total[field] = round(phase_total[field] + total[field], 6)
+    elapsed = time.monotonic() - start
+
+    # Nested phases overlap (a question's time includes its compiles and tests), so they don't add up to elapsed
+    for phase_total in phases.values():
+        phase_total["wall_time_per_submission"] = round(phase_total["wall_time"] / len(submissions), 6)
+
+    kinds = {}
+    for kind in submission_kinds:
+        of_kind = [res for res in results if res["kind"] == kind]
+        if len(of_kind) != 0:
+            kinds[kind] = latency_summary([res["wall_time"] for res in of_kind])
+            kinds[kind]["count"] = len(of_kind)
+            kinds[kind]["mean_score"] = round(sum(res["score"] for res in of_kind) / len(of_kind), 4)
+
+    return {
+        "time": datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "grader_version": ag.grader_version(),
+        "python": platform.python_version(),
+        "compiler": ag.compiler_version().splitlines()[0] if ag.compiler_version() else None,
+        "cores": ag.available_cores(),
+        "config": config,
+        "max_score": meta_data["assignment"]["total_points"],
+        "setup_time": round(setup_time, 4),
+        "elapsed": round(elapsed, 4),
+        "submissions": len(results),
+        "submissions_per_min": round(len(results) / elapsed * 60, 2) if elapsed > 0 else None,
+        "latency": latency_summary([res["wall_time"] for res in results]),
+        "kinds": kinds,
+        "phases": phases,
+        "results": results
+    }
+
+# A passing submission must get full marks and every other kind must lose some, otherwise the benchmark
+# isn't measuring what it should (or the grader is broken)
+def check_scores(report):
+    problems = []
+    max_score = float(report["max_score"])
+    for res in report["results"]:
+        if res["kind"] == "pass" and res["score"] != max_score:
+            problems.append(f'{res["id"]} should get full marks ({max_score}) but got {res["score"]}')
+        elif res["kind"] != "pass" and res["score"] >= max_score:
+            problems.append(f'{res["id"]} should lose marks but got {res["score"]}')
+    return problems
+
+def change(before, after):
+    if not before or after is None:
+        return ""
+    return f' ({(after - before) / before * 100:+.1f}%)'
+
+def compare_reports(before, after):
+    print(f'Compared with {before.get("git_commit") or before.get("grader_version")} ({before.get("time")}):')
+    if before.get("config") != after.get("config"):
+        print("  Warning: the benchmarks were run with different settings.")
+    print(f'  submissions/min: {before["submissions_per_min"]} -> {after["submissions_per_min"]}'
+          f'{change(before["submissions_per_min"], after["submissions_per_min"])}')
+    for stat in ["p50", "p95"]:
+        print(f'  {stat} latency: {before["latency"][stat]}s -> {after["latency"][stat]}s'
+              f'{change(before["latency"][stat], after["latency"][stat])}')
+    for phase, total in sorted(after["phases"].items()):
+        old = before.get("phases", {}).get(phase)
+        if old is not None:
+            print(f'  {phase} wall time per submission: {old["wall_time_per_submission"]}s -> '
+                  f'{total["wall_time_per_submission"]}s'
+                  f'{change(old["wall_time_per_submission"], total["wall_time_per_submission"])}')
+
+def print_report(report):
+    print(f'Graded {report["submissions"]} submissions in {report["elapsed"]}s: '
+          f'{report["submissions_per_min"]} submissions/min (setup {report["setup_time"]}s)')
+    latency = report["latency"]
+    print(f'Latency: p50 {latency["p50"]}s, p95 {latency["p95"]}s, max {latency["max"]}s')
+    for kind, stats in report["kinds"].items():
+        print(f'  {kind:8} x{stats["count"]}: p50 {stats["p50"]}s, p95 {stats["p95"]}s, mean score {stats["mean_score"]}')
+    print("Phases (total wall time, per submission):")
+    for phase, total in sorted(report["phases"].items(), key=lambda item: -item[1]["wall_time"]):
+        print(f'  {phase:22} {total["count"]:6} x  {total["wall_time"]:9.3f}s  {total["wall_time_per_submission"]:8.4f}s')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark grading throughput on a synthetic assignment")
+    parser.add_argument("--questions", type=int, default=4, help="number of questions")
+    parser.add_argument("--tests", type=int, default=8, help="test cases per question")
+    parser.add_argument("--output-bytes", type=int, default=4096, help="expected output size of each test")
+    parser.add_argument("--submissions", type=int, default=18, help="number of submissions to grade")
+    parser.add_argument("--mix", default=default_mix, help=f'relative numbers of each kind of submission ({default_mix})')
+    parser.add_argument("--timeout", type=int, default=1, help="CPU seconds each test may take")
+    parser.add_argument("--engine", choices=["threads", "async"], default="threads", help="grading engine")
+    parser.add_argument("--output", metavar="FILE", default="results/benchmark.json", help="JSON report")
+    parser.add_argument("--compare", metavar="FILE", help="JSON report of an earlier benchmark to compare with")
+    parser.add_argument("--work-dir", metavar="DIR", help="keep the generated assignment in DIR (must not exist)")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as ex:
+        parser.error(str(ex))
+    config = {
+        "questions": args.questions,
+        "tests": args.tests,
+        "output_bytes": args.output_bytes,
+        "mix": args.mix,
+        "timeout": args.timeout,
+        "engine": args.engine
+    }
+    before = None
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+    output_path = os.path.abspath(args.output)
+
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="gs-benchmark-")
+    kinds = submission_plan(mix, args.submissions)
+    submissions = generate_assignment(work_dir, args.questions, args.tests, args.output_bytes, kinds)
+    questions = make_questions(args.questions, args.tests, args.timeout)
+    print(f'Generated {args.questions} questions x {args.tests} tests and {len(submissions)} submissions in {work_dir}')
+
+    ag.compile_cache_dir = os.path.join(work_dir, "cache")
+    ag.async_engine = args.engine == "async"
+    ag.profile_file = None
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        with open(os.path.join(work_dir, "grading.log"), 'w') as log:
+            report = run_benchmark(questions, submissions, work_dir, config, log)
+    finally:
+        os.chdir(cwd)
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(report)
+    problems = check_scores(report)
+    for problem in problems:
+        print(f'Warning: {problem}')
+    if before is not None:
+        compare_reports(before, report)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report written to {args.output}')
+    sys.exit(1 if problems else 0)
@@ -18,8 +18,14 @@ pip3 install -r /autograder/source/requirements.txt
 apt-get install -y python3.8 python3.8-dev
 python3.8 -m pip install --upgrade pyyaml
 python3.8 -m pip install pytz
+# optional, compares the outputs of "numeric" tests as arrays
+python3.8 -m pip install numpy
 
 # Download version-controlled utility file
 wget https://raw.githubusercontent.com/rhys-brailsford/gs_autograder/main/autograder_util.py
 
 mv autograder_util.py autograder/autograder_util.py
+
+# Save the grading plan (grading_plan.json) and precompiled headers into the image,
+# and check the questions for mistakes
+cd /autograder && PYTHONPATH=/autograder python3.8 source/run_autograder --plan
@@ -0,0 +1,818 @@
+# Unit tests for autograder_util. Run with:
+#   python3 -m pytest tests (or python3 -m unittest discover tests)
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import autograder_util as ag
+
+
+def stream(data):
+    return ag.output_stream(data)
+
+# Expected output held in memory, as the manifest does for small fixtures
+def make_case(expected):
+    case = ag.TestCase("1-1", "00")
+    case.data["output"] = expected
+    return case
+
+def compare(expected, output, mode):
+    return ag.compare_output(make_case(expected), output, ag.default_comparator.merge(ag.Comparator(mode)))
+
+def write_file(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+# Runs each test in an empty working directory with its own submission/ and source/, as the grader reads
+# them relative to the working directory. The compile cache is disabled so nothing is written outside it.
+class WorkspaceTest(unittest.TestCase):
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.old_cache = ag.compile_cache
+        ag.compile_cache = False
+        ag.compile_cache_enabled.cache_clear()
+        self.dir = tempfile.mkdtemp(prefix='autograder-test-')
+        os.chdir(self.dir)
+        os.makedirs(ag.sub_prefix)
+        os.makedirs(ag.src_prefix)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.dir, ignore_errors=True)
+        ag.compile_cache = self.old_cache
+        ag.compile_cache_enabled.cache_clear()
+
+
+# ===============================
+#      Precompiled headers
+# ===============================
+class PrecompiledHeaderTests(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        self.old_settings = (ag.compile_cache_dir, ag.pch_std_headers)
+        ag.compile_cache = True
+        ag.compile_cache_enabled.cache_clear()
+        ag.compile_cache_dir = os.path.join(self.dir, "cache")
+        ag.pch_std_headers = ["cstddef"]
+        ag._pch_dirs.clear()
+
+    def tearDown(self):
+        ag.compile_cache_dir, ag.pch_std_headers = self.old_settings
+        ag._pch_dirs.clear()
+        super().tearDown()
+
+    def test_not_built_while_grading(self):
+        self.assertIsNone(ag.get_pch_dir(ag.compile_flags))
+        self.assertFalse(any(ag.compile_cache_dir in arg for arg in ag.compiler_cmd("-c", "x.cpp")))
+        self.assertFalse(os.path.exists(os.path.join(ag.compile_cache_dir, "pch")))
+
+    def test_built_ahead_of_time(self):
+        ag.build_precompiled_headers()
+        pch_dir = ag.get_pch_dir(ag.compile_flags)
+        self.assertTrue(os.path.isfile(os.path.join(pch_dir, "cstddef.gch")))
+        self.assertIsNotNone(ag.get_pch_dir(ag.check_only_flags))
+        self.assertIn(pch_dir, ag.compiler_cmd("-c", "x.cpp"))
+
+        # A later run finds them without building
+        ag._pch_dirs.clear()
+        self.assertEqual(ag.get_pch_dir(ag.compile_flags), pch_dir)
+
+
+# ===============================
+#        Program capture
+# ===============================
+class RunCapturedTests(unittest.TestCase):
+    def test_captures_both_streams(self):
+        run = ag.run_captured(["sh", "-c", "echo out; echo err >&2; exit 3"])
+        self.assertEqual((run.stdout, run.stderr, run.returncode), (b"out\n", b"err\n", 3))
+        self.assertIsNone(run.limit_exceeded)
+
+    def test_large_input_and_output(self):
+        data = os.urandom(4 * 1024 * 1024)
+        run = ag.run_captured(["cat"], data, stdout_limit=None)
+        self.assertEqual(run.stdout, data)
+
+    def test_program_may_ignore_input(self):
+        run = ag.run_captured(["true"], b"x" * (1024 * 1024))
+        self.assertEqual(run.returncode, 0)
+
+    def test_runaway_output_is_stopped(self):
+        run = ag.run_captured(["yes"], stdout_limit=1000, timeout=10)
+        self.assertEqual(run.limit_exceeded, "stdout")
+        self.assertEqual(len(run.stdout), 1000)
+        self.assertFalse(run.timed_out)
+
+        run = ag.run_captured(["sh", "-c", "yes >&2"], stderr_limit=100, timeout=10)
+        self.assertEqual((run.limit_exceeded, len(run.stderr)), ("stderr", 100))
+
+
+# ===============================
+#        Resource limits
+# ===============================
+class LimitsTests(unittest.TestCase):
+    def test_cpu_limit(self):
+        limits = ag.Limits(cpu_time=1, wall_time=20)
+        run = ag.run_captured(["sh", "-c", "while :; do :; done"], timeout=limits.wall_time, limits=limits)
+        self.assertEqual(run.resource_limit, "cpu")
+        self.assertFalse(run.timed_out)
+        self.assertGreaterEqual(run.user_time + run.sys_time, 0.9)
+        self.assertEqual(ag.limit_feedback(run, limits), "program exceeded the CPU time limit of 1 seconds.")
+
+    def test_file_size_limit(self):
+        limits = ag.Limits(file_size=1000)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run = ag.run_captured(["sh", "-c", "exec head -c 5000 /dev/zero > big"], cwd=tmp_dir, limits=limits)
+        self.assertEqual(run.resource_limit, "file_size")
+
+    def test_wall_timeout_kills_children(self):
+        run = ag.run_captured(["sh", "-c", "sleep 30 & echo $!; wait"], timeout=0.5)
+        self.assertTrue(run.timed_out)
+        self.assertLess(run.wall_time, 5)
+        child = int(run.stdout)
+        for _ in range(50):
+            try:
+                os.kill(child, 0)
+            except ProcessLookupError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail("background child is still running")
+
+    def test_crash_is_not_a_limit(self):
+        run = ag.run_captured(["sh", "-c", "kill -SEGV $$"], limits=ag.Limits(cpu_time=5, memory=1 << 30))
+        self.assertEqual(run.returncode, -11)
+        self.assertIsNone(run.resource_limit)
+
+    def test_test_limits_override_question(self):
+        case = make_case(b"")
+        limits = ag.get_test_limits(case, ag.Limits(cpu_time=2, memory=1 << 30))
+        self.assertEqual((limits.cpu_time, limits.memory, limits.wall_time), (2, 1 << 30, ag.test_wall_timeout))
+        case.data["limits"] = b'{"cpu_time": 3}'
+        limits = ag.get_test_limits(case, ag.Limits(cpu_time=2, memory=1 << 30))
+        self.assertEqual((limits.cpu_time, limits.memory), (3, 1 << 30))
+
+    def test_invalid_limits_file_ignored(self):
+        case = make_case(b"")
+        for data in [b'{"cpu": 3}', b'not json']:
+            case.data["limits"] = data
+            self.assertEqual(vars(ag.get_test_limits(case)), vars(ag.default_limits))
+
+
+# ===============================
+#         Test manifest
+# ===============================
+class ManifestTests(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        self.old_settings = (ag.compile_cache_dir, ag.fixture_preload_size)
+        ag.compile_cache_dir = os.path.join(self.dir, "cache")
+
+    def tearDown(self):
+        ag.compile_cache_dir, ag.fixture_preload_size = self.old_settings
+        super().tearDown()
+
+    def test_tests_in_id_order(self):
+        for name in ["output-1-1-10", "output-1-1-9", "output-1-1-00", "input-1-1-00", "args-1-1-05",
+                     "output-3-2-1-a", "test-1-1.cpp", "notes.txt"]:
+            write_file(ag.src_prefix + name, "x\n")
+        # A test is only defined by its expected output
+        self.assertEqual(ag.get_test_ids("1-1"), ["00", "9", "10"])
+        self.assertEqual(ag.get_test_ids("3-2-1"), ["a"])
+        self.assertEqual(ag.get_test_ids("2-1"), [])
+        case = ag.get_test_cases("1-1")[0]
+        self.assertEqual(sorted(case.files), ["input", "output"])
+        self.assertEqual(case.read("input"), b"x\n")
+        self.assertIsNone(case.read("args"))
+
+    def test_new_fixtures_found(self):
+        write_file(ag.src_prefix + "output-1-1-00", "x\n")
+        self.assertEqual(ag.get_test_ids("1-1"), ["00"])
+        time.sleep(0.01)
+        write_file(ag.src_prefix + "output-1-1-01", "x\n")
+        self.assertEqual(ag.get_test_ids("1-1"), ["00", "01"])
+
+    def test_only_small_fixtures_preloaded(self):
+        ag.fixture_preload_size = 4
+        write_file(ag.src_prefix + "input-1-1-00", "1234\n")
+        write_file(ag.src_prefix + "output-1-1-00", "123\n")
+        case = ag.get_test_cases("1-1")[0]
+        self.assertEqual(list(case.data), ["output"])
+        self.assertEqual(case.read("input"), b"1234\n")
+
+    def test_index_cached_on_disk(self):
+        ag.compile_cache = True
+        ag.compile_cache_enabled.cache_clear()
+        write_file(ag.src_prefix + "output-1-1-00", "x\n")
+        index = ag.load_fixture_index(ag.src_prefix)
+        cache_path = ag.manifest_cache_path(ag.src_prefix)
+        self.assertTrue(os.path.isfile(cache_path))
+
+        # While source/ is unchanged the cached index is used without scanning it
+        with open(cache_path) as f:
+            cached = json.load(f)
+        cached["index"] = {"9-9": {"00": {"output": "output-9-9-00"}}}
+        write_file(cache_path, json.dumps(cached))
+        self.assertEqual(ag.load_fixture_index(ag.src_prefix), cached["index"])
+
+        time.sleep(0.01)
+        write_file(ag.src_prefix + "output-1-1-01", "x\n")
+        self.assertEqual(sorted(ag.load_fixture_index(ag.src_prefix)["1-1"]), ["00", "01"])
+        self.assertEqual(index, {"1-1": {"00": {"output": "output-1-1-00"}}})
+
+
+# ===============================
+#       Output comparison
+# ===============================
+class OutputsMatchTests(unittest.TestCase):
+    def test_identical(self):
+        self.assertTrue(ag.outputs_match(stream(b"1\n2\n"), stream(b"1\n2\n")))
+
+    def test_ignores_trailing_whitespace_and_blank_lines(self):
+        self.assertTrue(ag.outputs_match(stream(b"a \t\n\n\nb\r\n"), stream(b"a\nb")))
+
+    def test_different_line(self):
+        self.assertFalse(ag.outputs_match(stream(b"1\n2\n"), stream(b"1\n3\n")))
+
+    def test_missing_and_extra_lines(self):
+        self.assertFalse(ag.outputs_match(stream(b"1\n2\n"), stream(b"1\n")))
+        self.assertFalse(ag.outputs_match(stream(b"1\n"), stream(b"1\n2\n")))
+
+    def test_fold_ignores_case(self):
+        self.assertFalse(ag.outputs_match(stream(b"Hello\n"), stream(b"hello\n")))
+        self.assertTrue(ag.outputs_match(stream(b"Hello\n"), stream(b"hello\n"), fold=True))
+
+    def test_blank_lines_never_cause_a_difference(self):
+        # diff -ZB reports this as different, see outputs_match
+        self.assertTrue(ag.outputs_match(stream(b"b\n\n"), stream(b" \n\x0c\x0b\n\x0c\nb\t")))
+
+    @unittest.skipIf(shutil.which("diff") is None, "diff isn't installed")
+    def test_accepts_whatever_diff_accepts(self):
+        rng = random.Random(7)
+        alphabet = [b"a", b"b", b" ", b"\t", b"\n", b"\n", b"\x0c", b"\x0b", b"\r"]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, "expected"), os.path.join(tmp_dir, "actual")]
+            for _ in range(300):
+                outputs = [b"".join(rng.choice(alphabet) for _ in range(rng.randint(0, 10))) for _ in paths]
+                for path, output in zip(paths, outputs):
+                    with open(path, 'wb') as f:
+                        f.write(output)
+                diff_match = subprocess.run(["diff", "-ZB"] + paths, stdout=subprocess.DEVNULL).returncode == 0
+                if diff_match:
+                    self.assertTrue(ag.outputs_match(stream(outputs[0]), stream(outputs[1])), outputs)
+
+
+class DiffExcerptTests(unittest.TestCase):
+    def test_changed_line(self):
+        self.assertEqual(ag.diff_excerpt(stream(b"1\n2\n3\n"), stream(b"1\nX\n3\n")), "2c2\n< 2\n---\n> X\n")
+
+    def test_deleted_and_added_lines(self):
+        self.assertEqual(ag.diff_excerpt(stream(b"1\n2\n"), stream(b"1\n")), "2d1\n< 2\n")
+        self.assertEqual(ag.diff_excerpt(stream(b"1\n"), stream(b"1\n2\n")), "1a2\n> 2\n")
+
+    def test_uses_original_line_numbers(self):
+        self.assertEqual(ag.diff_excerpt(stream(b"a\n\nb\n"), stream(b"a\n\n\nc\n")), "3c4\n< b\n---\n> c\n")
+
+    def test_limits_feedback_lines(self):
+        old_max = ag.diff_max_lines
+        ag.diff_max_lines = 3
+        try:
+            feedback = ag.diff_excerpt(stream(b"1\n2\n3\n"), stream(b"4\n5\n6\n"))
+        finally:
+            ag.diff_max_lines = old_max
+        self.assertEqual(feedback.splitlines()[:3], ["1,3c1,3", "< 1", "< 2"])
+        self.assertEqual(feedback.splitlines()[3], "... 5 more lines of differences not shown")
+
+
+class ComparatorTests(unittest.TestCase):
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            ag.Comparator("fuzzy")
+
+    def test_merge_keeps_unset_values(self):
+        merged = ag.default_comparator.merge(ag.Comparator("numeric", abs_tol=0.5))
+        self.assertEqual((merged.mode, merged.abs_tol, merged.rel_tol), ("numeric", 0.5, ag.default_comparator.rel_tol))
+
+    def test_diff(self):
+        self.assertEqual(compare(b"1 2\n", b"1 2 \n", "diff"), "")
+        self.assertEqual(compare(b"1 2\n", b"1  2\n", "diff"), "1c1\n< 1 2\n---\n> 1  2\n")
+
+    def test_case_insensitive(self):
+        self.assertEqual(compare(b"YES\n", b"yes\n", "case-insensitive"), "")
+        self.assertNotEqual(compare(b"YES\n", b"no\n", "case-insensitive"), "")
+
+    def test_token(self):
+        self.assertEqual(compare(b"1 2\n3\n", b"1\n2   3", "token"), "")
+        self.assertEqual(compare(b"1 2 3\n", b"1 5 3\n", "token"), "Token 2: expected 2, got 5\n")
+        self.assertEqual(compare(b"1 2\n", b"1\n", "token"), "Expected 2 tokens, got 1\n")
+
+    def test_numeric(self):
+        self.assertEqual(compare(b"1.0 2.5\n", b"1.000001 2.5000001\n", "numeric"), "")
+        self.assertEqual(compare(b"1.0\n", b"1.1\n", "numeric"), "Token 1: expected 1.0, got 1.1\n")
+        self.assertEqual(compare(b"nan inf -inf\n", b"nan inf -inf\n", "numeric"), "")
+        self.assertNotEqual(compare(b"inf\n", b"-inf\n", "numeric"), "")
+
+    def test_numeric_words_compare_exactly(self):
+        self.assertEqual(compare(b"total 3.0\n", b"total 3\n", "numeric"), "")
+        self.assertEqual(compare(b"total 3.0\n", b"Total 3\n", "numeric"), "Token 1: expected total, got Total\n")
+
+    def test_numeric_without_numpy(self):
+        old_numpy = ag.optional_numpy
+        ag.optional_numpy = lambda: None
+        try:
+            self.test_numeric()
+            self.assertEqual(compare(b"1 2\n", b"1\n", "numeric"), "Expected 2 tokens, got 1\n")
+        finally:
+            ag.optional_numpy = old_numpy
+
+    def test_numeric_counts_tokens(self):
+        self.assertEqual(compare(b"1 2\n", b"1\n", "numeric"), "Expected 2 tokens, got 1\n")
+        self.assertEqual(compare(b"1 2\n", b"1 3 4\n", "numeric"), "Token 2: expected 2, got 3\nExpected 2 tokens, got 3\n")
+        self.assertEqual(compare(b"1 -2\n", b"1-2\n", "numeric"), "Token 1: expected 1, got 1-2\nExpected 2 tokens, got 1\n")
+        self.assertEqual(compare(b"\n", b"", "numeric"), "")
+
+    @unittest.skipIf(ag.optional_numpy() is None, "numpy isn't installed")
+    def test_numbers_parsed_in_bulk(self):
+        self.assertEqual(ag.parse_numbers(b"1 2.5\n\t-3e2 .5 5. +INF nan\n").tolist()[:5], [1, 2.5, -300, 0.5, 5])
+        self.assertEqual(ag.parse_numbers(b"1 \n 2\n\n").tolist(), [1, 2])
+        self.assertEqual(len(ag.parse_numbers(b" \n")), 0)
+        for output in [b"1 x", b"1-2", b"1e", b"0x10", b"1,5", b"1 2,"]:
+            self.assertIsNone(ag.parse_numbers(output), output)
+
+    def test_regex_line(self):
+        self.assertEqual(compare(b"Total: \\d+\n", b"Total: 42\n", "regex-line"), "")
+        self.assertEqual(compare(b"Total: \\d+\n", b"Total: x\n", "regex-line"),
+                         "Line 1: Total: x\n    doesn't match /Total: \\d+/\n")
+        self.assertEqual(compare(b"a\n", b"a\nb\n", "regex-line"), "Line 2: unexpected line: b\n")
+        self.assertIn("Invalid pattern /(/", compare(b"(\n", b"(\n", "regex-line"))
+
+
+# ===============================
+#           Test runs
+# ===============================
+class RunTestCaseTests(WorkspaceTest):
+    def write_program(self, script):
+        path = os.path.join(self.dir, "program.sh")
+        write_file(path, "#!/bin/sh\n" + script)
+        os.chmod(path, 0o755)
+        return path
+
+    def test_relative_paths_resolve_from_scratch_dir(self):
+        write_file(ag.src_prefix + "data.txt", "42\n")
+        write_file(ag.sub_prefix + "notes.txt", "hi\n")
+        program = self.write_program("cat source/data.txt submission/notes.txt\n")
+        self.assertEqual(ag.run_test_case(make_case(b"42\nhi\n"), 1, program)[0], 1)
+
+    def test_output_limit_set_per_test(self):
+        program = self.write_program("printf '%0100d' 0\n")
+        case = make_case(b"0" * 100)
+        self.assertEqual(ag.run_test_case(case, 1, program)[0], 1)
+        case.data["limits"] = b'{"output_size": 10}'
+        score, feedback, timed_out = ag.run_test_case(case, 1, program)
+        self.assertEqual(score, 0)
+        self.assertIn("more than 10 bytes to stdout", feedback)
+
+    def test_written_files_stay_in_scratch_dir(self):
+        write_file(ag.src_prefix + "data.txt", "42\n")
+        program = self.write_program("echo 1 > written.txt\npwd\n")
+        score, feedback, timed_out = ag.run_test_case(make_case(b"x\n"), 1, program)
+        scratch_dir = feedback.split("> ")[1].splitlines()[0]
+        self.assertNotEqual(scratch_dir, self.dir)
+        self.assertFalse(os.path.exists("written.txt"))
+        self.assertFalse(os.path.exists(scratch_dir))
+        # Removing the scratch directory mustn't follow its links
+        self.assertTrue(os.path.exists(ag.src_prefix + "data.txt"))
+
+
+# ===============================
+#     Batched test drivers
+# ===============================
+class ParseBatchedOutputTests(unittest.TestCase):
+    nonce = b"abc123"
+
+    def test_frames(self):
+        data = b"abc123 00 2\n1\nabc123 01 6\nx\ny z\n"
+        self.assertEqual(ag.parse_batched_output(data, self.nonce, {"00", "01"}), {"00": b"1\n", "01": b"x\ny z\n"})
+
+    def test_empty_output(self):
+        self.assertEqual(ag.parse_batched_output(b"abc123 00 0\n", self.nonce, {"00"}), {"00": b""})
+
+    def test_stops_at_frame_without_nonce(self):
+        data = b"abc123 00 2\n1\n00 2\n2\nabc123 01 2\n3\n"
+        self.assertEqual(ag.parse_batched_output(data, self.nonce, {"00", "01"}), {"00": b"1\n"})
+
+    def test_stops_at_incomplete_frame(self):
+        data = b"abc123 00 2\n1\nabc123 01 10\nshort"
+        self.assertEqual(ag.parse_batched_output(data, self.nonce, {"00", "01"}), {"00": b"1\n"})
+        self.assertEqual(ag.parse_batched_output(b"abc123 00 2", self.nonce, {"00"}), {})
+
+    def test_stops_at_malformed_header(self):
+        data = b"abc123 00 2\n1\nabc123 01 two\n2\n"
+        self.assertEqual(ag.parse_batched_output(data, self.nonce, {"00", "01"}), {"00": b"1\n"})
+
+    def test_frame_inside_output_is_data(self):
+        data = b"abc123 00 14\nabc123 01 1\nx\n"
+        self.assertEqual(ag.parse_batched_output(data, self.nonce, {"00", "01"}), {"00": b"abc123 01 1\nx\n"})
+
+    def test_unknown_test(self):
+        with self.assertRaises(ValueError):
+            ag.parse_batched_output(b"abc123 07 2\n1\n", self.nonce, {"00"})
+
+    def test_repeated_test(self):
+        with self.assertRaises(ValueError):
+            ag.parse_batched_output(b"abc123 00 2\n1\nabc123 00 2\n2\n", self.nonce, {"00"})
+
+
+# ===============================
+#            Results
+# ===============================
+class FeedbackBufferTests(unittest.TestCase):
+    def test_joins_feedback(self):
+        feedback = ag.FeedbackBuffer()
+        feedback += "a\n"
+        feedback += "b\n"
+        self.assertEqual(str(feedback), "a\nb\n")
+
+    def test_cut_at_line_boundary(self):
+        feedback = ag.FeedbackBuffer(limit=10)
+        feedback += "123\n456\n789\n"
+        self.assertEqual(str(feedback), "123\n456\n... 1 more lines of feedback not shown\n")
+        feedback += "x\ny\n"
+        self.assertEqual(str(feedback), "123\n456\n... 3 more lines of feedback not shown\n")
+
+    def test_limit_counts_encoded_bytes(self):
+        feedback = ag.FeedbackBuffer(limit=5)
+        feedback += "\u00e9\u00e9\n\u00e9\n"
+        self.assertEqual(str(feedback), "\u00e9\u00e9\n... 1 more lines of feedback not shown\n")
+
+
+class WriteResultsTests(WorkspaceTest):
+    def result_json(self):
+        return {"score": 2.5, "visibility": "visible",
+                "tests": [{"name": "Q1-1", "score": 2.5, "output": "caf\u00e9 \"quoted\"\n"}, {"name": "Q1-2"}]}
+
+    def test_same_as_json_dump(self):
+        for result_json in [self.result_json(), {}, {"tests": []}]:
+            ag.write_results(result_json, "results.json")
+            with open("results.json") as f:
+                self.assertEqual(f.read(), json.dumps(result_json))
+        self.assertFalse(any(name.endswith(".tmp") for name in os.listdir(".")))
+
+    def test_failed_write_keeps_previous_results(self):
+        ag.write_results(self.result_json(), "results.json")
+        with self.assertRaises(TypeError):
+            ag.write_results({"score": 0, "tests": [{"output": object()}]}, "results.json")
+        with open("results.json") as f:
+            self.assertEqual(json.load(f), self.result_json())
+        self.assertFalse(any(name.endswith(".tmp") for name in os.listdir(".")))
+
+
+# ===============================
+#       Performance tests
+# ===============================
+class FitSlopeTests(unittest.TestCase):
+    def test_exact_line(self):
+        self.assertAlmostEqual(ag.fit_slope([1, 2, 3, 4], [3, 5, 7, 9]), 2.0)
+
+    def test_least_squares(self):
+        self.assertAlmostEqual(ag.fit_slope([0, 1, 2], [0, 2, 1]), 0.5)
+
+    def test_single_x(self):
+        self.assertEqual(ag.fit_slope([5, 5], [1, 2]), 0.0)
+
+    def test_class_slopes(self):
+        sizes = [1000, 2000, 4000, 8000]
+        self.assertAlmostEqual(ag.class_slope("1", sizes), 0.0)
+        self.assertAlmostEqual(ag.class_slope("n", sizes), 1.0)
+        self.assertAlmostEqual(ag.class_slope("n^2", sizes), 2.0)
+        self.assertTrue(1.0 < ag.class_slope("n log n", sizes) < 1.2)
+
+
+# ===============================
+#     Question result cache
+# ===============================
+class QuestionKeyTests(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        write_file(ag.sub_prefix + "function-1-1.cpp", "int f() { return 1; }\n")
+        write_file(ag.src_prefix + "test-1-1.cpp", "int main() {}\n")
+        write_file(ag.src_prefix + "output-1-1-00", "1\n")
+
+    def question(self, test_points = 1):
+        return ag.Question("1-1", max_points=3, test_points=test_points, tester_idx=0,
+                           compile_tests=[ag.CompileTest(submitted_files=["function-1-1.cpp"],
+                                                         provided_files=["test-1-1.cpp"], points=1)])
+
+    def test_stable(self):
+        self.assertEqual(ag.question_key(self.question()), ag.question_key(self.question()))
+
+    def test_submitted_file_changes_key(self):
+        key = ag.question_key(self.question())
+        write_file(ag.sub_prefix + "function-1-1.cpp", "int f() { return 2; }\n")
+        self.assertNotEqual(ag.question_key(self.question()), key)
+
+    def test_submitted_header_changes_key(self):
+        key = ag.question_key(self.question())
+        write_file(ag.sub_prefix + "helper.h", "#pragma once\n")
+        self.assertNotEqual(ag.question_key(self.question()), key)
+
+    def test_included_files_change_key(self):
+        os.makedirs(ag.sub_prefix + "detail")
+        for name in ["list.tpp", "table.inc", "helper.cpp", "detail/node.hh"]:
+            key = ag.question_key(self.question())
+            write_file(ag.sub_prefix + name, "// included by function-1-1.cpp\n")
+            self.assertNotEqual(ag.question_key(self.question()), key, name)
+            key = ag.question_key(self.question())
+            write_file(ag.sub_prefix + name, "// edited\n")
+            self.assertNotEqual(ag.question_key(self.question()), key, name)
+
+    def test_submission_hashed_once(self):
+        submitted_hash = ag.submission_key()
+        self.assertEqual(ag.question_key(self.question(), submitted_hash), ag.question_key(self.question()))
+
+    def test_question_definition_changes_key(self):
+        self.assertNotEqual(ag.question_key(self.question(1)), ag.question_key(self.question(2)))
+
+
+# ===============================
+#  Checkpoints and time budget
+# ===============================
+real_compile_object = ag.compile_object
+real_compile_object_async = ag.compile_object_async
+
+# Stand in for compile_object(_async): the time budget runs out as soon as the first file is compiled
+def expiring_compile_object(*args):
+    result = real_compile_object(*args)
+    ag._grading_deadline = time.monotonic() - 1
+    return result
+
+async def expiring_compile_object_async(*args):
+    result = await real_compile_object_async(*args)
+    ag._grading_deadline = time.monotonic() - 1
+    return result
+
+class TimeBudgetTests(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        self.old_settings = (ag.time_budget, ag.async_engine, ag.compile_workers, ag.question_workers)
+        ag.time_budget = 60
+        ag.compile_workers = 1
+        ag.question_workers = 1
+        for qid in ["1-1", "1-2"]:
+            write_file(ag.sub_prefix + f'function-{qid}.cpp', "int f() { return 1; }\n")
+            write_file(ag.src_prefix + f'test-{qid}.cpp',
+                       "#include <cstdio>\nint f();\nint main() { std::printf(\"%d\\n\", f()); }\n")
+            write_file(ag.src_prefix + f'output-{qid}-00', "1\n")
+
+    def tearDown(self):
+        ag.time_budget, ag.async_engine, ag.compile_workers, ag.question_workers = self.old_settings
+        ag.compile_object = real_compile_object
+        ag.compile_object_async = real_compile_object_async
+        ag._grading_deadline = None
+        super().tearDown()
+
+    def questions(self):
+        return [ag.Question(qid, max_points=3, file_points=1, test_points=1, tester_idx=0,
+                            compile_tests=[ag.CompileTest(submitted_files=[f'function-{qid}.cpp'],
+                                                          provided_files=[f'test-{qid}.cpp'], points=1)])
+                for qid in ["1-1", "1-2"]]
+
+    def grade(self):
+        return ag.grade_submission(self.questions(), meta_data=batch_metadata(), results_path="results.json")
+
+    def test_checkpoint_matches_result(self):
+        result_json = self.grade()
+        self.assertEqual([test["score"] for test in result_json["tests"]], [3, 3, 0])
+        with open("results.json") as f:
+            self.assertEqual(json.load(f), result_json)
+
+    def test_no_time_left_skips_every_question(self):
+        ag.time_budget = 0
+        result_json = self.grade()
+        self.assertEqual(result_json["score"], 0)
+        for test in result_json["tests"][:2]:
+            self.assertIn("was not graded", test["output"])
+
+    def check_budget_ran_out_while_compiling(self):
+        result_json = self.grade()
+        first, second = result_json["tests"][:2]
+        # Q1-1 started compiling in time: it keeps its file marks, its program is skipped, not failed
+        self.assertEqual(first["score"], 1)
+        self.assertIn("All files found", first["output"])
+        self.assertIn("skipped: the grading time limit", first["output"])
+        self.assertNotIn("failed to compile", first["output"])
+        self.assertIn("Q1-2 was not graded", second["output"])
+        with open("results.json") as f:
+            self.assertEqual(json.load(f), result_json)
+
+    def test_budget_runs_out_while_compiling(self):
+        ag.compile_object = expiring_compile_object
+        self.check_budget_ran_out_while_compiling()
+
+    def test_budget_runs_out_while_compiling_async(self):
+        ag.async_engine = True
+        ag.compile_object_async = expiring_compile_object_async
+        self.check_budget_ran_out_while_compiling()
+
+    def test_compile_marks_kept_after_budget_runs_out(self):
+        questions = self.questions()[:1]
+        ag.start_time_budget()
+        objects = {path: real_compile_object(path, self.dir, False) for path in ag.translation_units(questions)}
+        ag._grading_deadline = time.monotonic() - 1
+        current_test = ag.grade_question(questions[0], objects)
+        self.assertEqual(current_test["score"], 2)
+        self.assertIn("Test00 skipped", current_test["output"])
+        self.assertFalse(current_test["cacheable"])
+
+
+# ===============================
+#         Grading plan
+# ===============================
+class PlanTests(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        write_file(ag.src_prefix + "test-1-1.cpp", "int main() {}\n")
+        write_file(ag.src_prefix + "input-1-1-00", "1\n")
+        write_file(ag.src_prefix + "output-1-1-00", "1\n")
+
+    def questions(self, max_points = 3):
+        return [ag.Question("1-1", max_points=max_points, file_points=1, test_points=1, tester_idx=0,
+                            compile_tests=[ag.CompileTest(submitted_files=["function-1-1.cpp"],
+                                                          provided_files=["test-1-1.cpp"], points=1)])]
+
+    # Returns True if loading the plan had to rebuild it
+    def load(self, questions):
+        log = io.StringIO()
+        with redirect_stdout(log):
+            ag.load_plan(questions, "plan.json")
+        return "rebuilding" in log.getvalue()
+
+    def test_saved_and_reused(self):
+        self.assertTrue(self.load(self.questions()))
+        questions = self.questions()
+        self.assertFalse(self.load(questions))
+        self.assertEqual(questions[0].required_files, ["function-1-1.cpp"])
+        self.assertEqual(questions[0].provided_hash, ag.provided_key(self.questions()[0]))
+        self.assertEqual(ag.get_test_ids("1-1"), ["00"])
+        self.assertEqual(ag.get_test_cases("1-1")[0].read("input"), b"1\n")
+
+    def test_out_of_date_plan_rebuilt(self):
+        self.load(self.questions())
+        self.assertTrue(self.load(self.questions(max_points=4)))
+        self.assertFalse(self.load(self.questions(max_points=4)))
+        time.sleep(0.01)
+        write_file(ag.src_prefix + "test-1-1.cpp", "int main() { return 0; }\n")
+        self.assertTrue(self.load(self.questions(max_points=4)))
+
+    def test_problems(self):
+        questions = self.questions(max_points=5) + [
+            ag.Question("1-1", max_points=1, compile_tests=[ag.CompileTest(provided_files=["missing.cpp"], points=1)]),
+            ag.Question("2-1", max_points=0, perf_tests=[ag.PerformanceTest("grow", [10])])]
+        self.assertEqual(ag.check_questions(questions), [
+            "Q1-1: max_points is 5 but its tests are worth 3 points.",
+            "Q1-1: question id is used more than once.",
+            "Q1-1: provided file source/missing.cpp does not exist.",
+            "Q2-1: has tests but no CompileTest to build the test driver, they will never run."])
+
+
+# ===============================
+#         Batch grading
+# ===============================
+real_grade_batch_job = ag.grade_batch_job
+
+# Stands in for grade_batch_job in forked batch workers: "crash" kills its worker after the others have
+# started, and "slow" is still being graded when that happens
+def crashing_grade_batch_job(job, started_path = None):
+    if started_path is not None:
+        write_file(started_path, "")
+    if job[0] == "crash":
+        time.sleep(0.3)
+        os._exit(1)
+    if job[0] == "slow":
+        time.sleep(1.0)
+    return real_grade_batch_job(job, started_path)
+
+def batch_metadata():
+    return {"created_at": "2022-02-14T00:00:00+00:00", "users": [], "previous_submissions": [],
+            "assignment": {"total_points": 10, "due_date": "2022-02-15T00:00:00+00:00"}}
+
+class BatchTests(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        self.subs = os.path.join(self.dir, "subs")
+        self.output = os.path.join(self.dir, "out.jsonl")
+
+    def tearDown(self):
+        ag.grade_batch_job = real_grade_batch_job
+        super().tearDown()
+
+    def add_submissions(self, *sub_ids):
+        for sub_id in sub_ids:
+            os.makedirs(os.path.join(self.subs, sub_id))
+            write_file(os.path.join(self.subs, sub_id, "submission_metadata.json"), json.dumps(batch_metadata()))
+
+    def records(self):
+        with open(self.output) as f:
+            return {record["id"]: record for record in map(json.loads, f)}
+
+    def test_log_name_stays_in_log_dir(self):
+        self.assertEqual(ag.batch_log_name("../../etc/passwd"), "_.._etc_passwd.log")
+        self.assertEqual(ag.batch_log_name(".hidden"), "hidden.log")
+        self.assertEqual(ag.batch_log_name("a1_b-2.c"), "a1_b-2.c.log")
+
+    def test_grades_every_submission(self):
+        self.add_submissions("a", "b", "c")
+        ag.run_batch([], self.subs, self.output, workers=2, log_dir=os.path.join(self.dir, "logs"))
+        records = self.records()
+        self.assertEqual(sorted(records), ["a", "b", "c"])
+        self.assertTrue(all(record["score"] == 0 for record in records.values()))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, "logs"))), ["a.log", "b.log", "c.log"])
+
+    def test_dead_worker_only_fails_its_own_submission(self):
+        self.add_submissions("crash", "slow", "a", "b")
+        ag.grade_batch_job = crashing_grade_batch_job
+        ag.run_batch([], self.subs, self.output, workers=2)
+        records = self.records()
+        self.assertEqual(sorted(records), ["a", "b", "crash", "slow"])
+        self.assertEqual(records["crash"]["error"],
+                         f'worker process died while grading it {ag.batch_max_attempts} times')
+        for sub_id in ["slow", "a", "b"]:
+            self.assertEqual(records[sub_id]["score"], 0)
+
+
+# ===============================
+#    Distributed grading spool
+# ===============================
+class SpoolTests(WorkspaceTest):
+    def setUp(self):
+        super().setUp()
+        self.spool = os.path.join(self.dir, "spool")
+        ag.init_spool(self.spool)
+
+    # Claims a job for worker_id as a worker would, optionally with a heartbeat age seconds old
+    def claim(self, worker_id, sub_id, heartbeat_age = None, attempts = 0):
+        if heartbeat_age is not None:
+            path = ag.spool_path(self.spool, "heartbeats", worker_id)
+            ag.touch_heartbeat(path)
+            os.utime(path, (time.time() - heartbeat_age,) * 2)
+        name = ag.spool_file_name(sub_id)
+        ag.write_spool_file(self.spool, "queue", name, {"id": sub_id, "dir": "", "metadata": None,
+                                                        "attempts": attempts})
+        os.makedirs(ag.spool_path(self.spool, "claimed", worker_id), exist_ok=True)
+        return ag.claim_job(self.spool, worker_id)
+
+    def age_claim(self, worker_id, age):
+        path = ag.spool_path(self.spool, "claimed", worker_id)
+        os.utime(path, (time.time() - age,) * 2)
+
+    def test_live_worker_keeps_job(self):
+        path = self.claim("w1", "s1", heartbeat_age=0)
+        self.assertEqual(ag.requeue_dead_workers(self.spool), [])
+        self.assertTrue(os.path.exists(path))
+
+    def test_new_claim_without_heartbeat_is_not_dead(self):
+        path = self.claim("w1", "s1")
+        self.assertEqual(ag.requeue_dead_workers(self.spool), [])
+        self.assertTrue(os.path.exists(path))
+
+    def test_old_claim_without_heartbeat_is_requeued(self):
+        self.claim("w1", "s1")
+        self.age_claim("w1", ag.spool_worker_timeout + 1)
+        self.assertEqual(ag.requeue_dead_workers(self.spool), [])
+        job = ag.read_spool_file(ag.spool_path(self.spool, "queue", ag.spool_file_name("s1")))
+        self.assertEqual(job["attempts"], 1)
+        self.assertEqual(ag.list_spool(self.spool, "claimed"), [])
+
+    def test_stale_heartbeat_is_requeued(self):
+        self.claim("w1", "s1", heartbeat_age=ag.spool_worker_timeout + 1)
+        ag.requeue_dead_workers(self.spool)
+        self.assertEqual(ag.list_spool(self.spool, "queue"), [ag.spool_file_name("s1")])
+
+    def test_gives_up_after_max_attempts(self):
+        self.claim("w1", "s1", heartbeat_age=ag.spool_worker_timeout + 1, attempts=ag.spool_max_attempts - 1)
+        failed = ag.requeue_dead_workers(self.spool)
+        self.assertEqual([record["id"] for record in failed], ["s1"])
+        self.assertEqual(ag.list_spool(self.spool, "queue"), [])
+
+    def test_claim_recreates_removed_claim_dir(self):
+        os.makedirs(ag.spool_path(self.spool, "claimed", "w1"))
+        ag.write_spool_file(self.spool, "queue", "job.json", {"id": "s1"})
+        os.rmdir(ag.spool_path(self.spool, "claimed", "w1"))
+        self.assertEqual(ag.claim_job(self.spool, "w1"), ag.spool_path(self.spool, "claimed", "w1", "job.json"))
+
+    def test_stop_file_from_earlier_run_is_ignored(self):
+        write_file(ag.spool_path(self.spool, "stop"), "")
+        self.assertTrue(ag.spool_stopped(self.spool, time.time() - 60))
+        self.assertFalse(ag.spool_stopped(self.spool, time.time() + 60))
+
+
+if __name__ == '__main__':
+    unittest.main()